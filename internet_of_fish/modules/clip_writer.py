@@ -0,0 +1,246 @@
+import os, csv, copy, time
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from internet_of_fish.modules import mptools
+from internet_of_fish.modules import detections
+from internet_of_fish.modules import inference
+from internet_of_fish.modules.utils import gen_utils
+
+
+# a slice of the frames of a clip, sent after its ClipRequest (see ClipRequest.split). last is True for the final slice
+ClipChunk = namedtuple('ClipChunk', ['entries', 'last'])
+
+
+class ClipRequest:
+
+    # number of frames per ClipChunk. Around a megabyte of jpegs at the default resolution
+    CHUNK_FRAMES = 25
+
+    def __init__(self, msg, buffer_entries, fallback_fps, notify=True):
+        """
+        handoff from the DetectorWorker to the ClipWriterWorker when a possible spawning event is detected
+
+        :param msg: message that will be sent along with the clip once it is written
+        :type msg: str
+        :param buffer_entries: buffered frames (as jpeg bytes) and their detections, oldest first
+        :type buffer_entries: list[detector.BufferEntry]
+        :param fallback_fps: framerate to use if it cannot be worked out from the frame capture times
+        :type fallback_fps: float
+        :param notify: if True, send the NOTIFY event once the clip is written. Set to False when the notification is
+            handled elsewhere (e.g., by the collector, when it saves a clip from its h264 buffer)
+        :type notify: bool
+        """
+        self.msg, self.buffer_entries, self.fallback_fps = msg, buffer_entries, fallback_fps
+        self.notify = notify
+        # kept separately from the frames, so that they survive split
+        self.n_frames = len(buffer_entries)
+        self.first_cap_time = buffer_entries[0].cap_time if buffer_entries else None
+        self.frame_rate = self.fps()
+
+    def __str__(self):
+        return f'ClipRequest({self.n_frames} frames: {self.msg})'
+
+    def split(self, chunk_frames=None):
+        """
+        the messages to send through the clip queue for this request: a copy of the request without its frames,
+        followed by the frames in ClipChunks. This keeps each message small, rather than pickling the whole event
+        buffer in one go, and lets the ClipWriterWorker start encoding before the last frames arrive
+        :param chunk_frames: max number of frames per chunk. Defaults to CHUNK_FRAMES
+        :type chunk_frames: int
+        :rtype: list[ClipRequest | ClipChunk]
+        """
+        chunk_frames = chunk_frames or self.CHUNK_FRAMES
+        header = copy.copy(self)
+        header.buffer_entries = []
+        chunks = [ClipChunk(self.buffer_entries[i:i + chunk_frames], i + chunk_frames >= self.n_frames)
+                  for i in range(0, self.n_frames, chunk_frames)]
+        return [header] + chunks
+
+    def fps(self):
+        """average framerate of the buffered frames, based on their capture times"""
+        if len(self.buffer_entries) > 1:
+            span_secs = (self.buffer_entries[-1].cap_time - self.buffer_entries[0].cap_time) / 1000
+            if span_secs > 0:
+                return (len(self.buffer_entries) - 1) / span_secs
+        return self.fallback_fps
+
+
+def draw_dets(frame, dets, labels, pipe_id):
+    """
+    draw detection boxes onto a BGR frame, in place. Fish fully inside the pipe are drawn in green and the rest in red.
+    The pipe is drawn in red if no fish are inside it, yellow if one is, and green if two or more are
+
+    :param frame: BGR image, as a numpy array
+    :type frame: np.ndarray
+    :param dets: detections for the frame (see detections.DET_DTYPE)
+    :type dets: np.ndarray
+    :param labels: mapping from detection ids to label strings
+    :type labels: dict[int, str]
+    :param pipe_id: detection id for the pipe
+    :type pipe_id: int
+    """
+    green, yellow, red = (0, 255, 0), (0, 255, 255), (0, 0, 255)
+
+    def draw_det(det_, box_, color_):
+        xmin, ymin, xmax, ymax = box_.astype(int)
+        cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), color_, 2)
+        cv2.putText(frame, f'{labels.get(int(det_["id"]), det_["id"])} {det_["score"]:.2f}',
+                    (xmin + 10, ymin + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color_)
+
+    fish_dets = dets[dets['id'] != pipe_id]
+    pipe_det = dets[dets['id'] == pipe_id][:1]
+    fish_boxes = detections.boxes(fish_dets)
+    if len(pipe_det):
+        pipe_box = detections.boxes(pipe_det)[0]
+        fish_inside = detections.inside(fish_boxes, pipe_box)
+    else:
+        fish_inside = np.zeros(len(fish_dets), dtype=bool)
+    for det, box, inside in zip(fish_dets, fish_boxes, fish_inside):
+        draw_det(det, box, green if inside else red)
+    if len(pipe_det):
+        intersect_count = np.count_nonzero(fish_inside)
+        draw_det(pipe_det[0], pipe_box, red if not intersect_count else yellow if intersect_count == 1 else green)
+    return frame
+
+
+class AnnotatedVideoWriter:
+    def __init__(self, vid_path, fps, index_path=None):
+        """
+        appends annotated frames to a single video as they are produced. Used in place of an event buffer when the
+        detector runs on a source video, so that every processed frame ends up in one continuous output video.
+
+        :param vid_path: path for the output video. The file is created when the first frame is written
+        :type vid_path: str
+        :param fps: framerate of the output video
+        :type fps: float
+        :param index_path: if given, path for a csv sidecar that maps each output frame to the source frame number and
+            cap_time it came from
+        :type index_path: str
+        """
+        self.vid_path, self.fps, self.index_path = vid_path, fps, index_path
+        self.video = None
+        self.index_file = None
+        self.index_writer = None
+        self.frame_count = 0
+
+    def write(self, frame, cap_time, source_frame=None):
+        """
+        :param frame: annotated BGR image, as a numpy array
+        :type frame: np.ndarray
+        :param cap_time: capture time of the frame
+        :type cap_time: int
+        :param source_frame: frame number of the frame within the source video
+        :type source_frame: int
+        """
+        if self.video is None:
+            height, width = frame.shape[:2]
+            fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
+            self.video = cv2.VideoWriter(self.vid_path, fourcc, self.fps, (width, height))
+            if self.index_path:
+                self.index_file = open(self.index_path, 'w', newline='')
+                self.index_writer = csv.writer(self.index_file)
+                self.index_writer.writerow(['frame', 'source_frame', 'cap_time'])
+        self.video.write(frame)
+        if self.index_writer:
+            self.index_writer.writerow([self.frame_count, source_frame, cap_time])
+        self.frame_count += 1
+
+    def close(self):
+        if self.video is not None:
+            self.video.release()
+        if self.index_file is not None:
+            self.index_file.close()
+
+
+class ClipWriterWorker(mptools.QueueProcWorker, metaclass=gen_utils.AutologMetaclass):
+    """
+    turns the frames buffered by the DetectorWorker into an annotated event clip, and sends the NOTIFY event once the
+    clip is ready. Runs in its own process so that detection carries on at full rate while the clip is written. Each
+    clip arrives as a ClipRequest followed by its frames in ClipChunks (see ClipRequest.split), and the frames are
+    encoded as they arrive
+    """
+
+    def startup(self):
+        self.vid_dir = self.defs.PROJ_VID_DIR
+        self.labels = inference.read_labels(inference.locate_labels(self.defs.MODELS_DIR, self.metadata['model_id']))
+        self.pipe_id = {val: key for key, val in self.labels.items()}['pipe']
+        # an event detected right before a mode switch is the most likely to be cut short, so leave time to finish it
+        self.FLUSH_WAIT_SECS = self.defs.DEFAULT_SHUTDOWN_WAIT_SECS / 2
+        self.clip = None
+        self.vid_path = None
+        self.video = None
+
+    def main_loop(self):
+        """
+        like QueueProcWorker.main_loop, except that once the shutdown event is set, the clip requests already in the
+        queue are still written, up to the END sent by the DetectorWorker as it shuts down (or until FLUSH_WAIT_SECS
+        pass without it arriving)
+        """
+        while not self.shutdown_event.is_set():
+            item = self.work_q.wait_get(wakeup=self.shutdown_event)
+            if item == 'END':
+                return
+            if item:
+                self.main_func(item)
+        deadline = time.time() + self.FLUSH_WAIT_SECS
+        while True:
+            item = self.work_q.wait_get(timeout=mptools.sleep_secs(self.FLUSH_WAIT_SECS, deadline))
+            if item is None:
+                self.logger.warning(f'no END from the detector within {self.FLUSH_WAIT_SECS} seconds of shutdown')
+                return
+            if item == 'END':
+                return
+            self.main_func(item)
+
+    def main_func(self, item):
+        if isinstance(item, ClipRequest):
+            self.start_clip(item)
+        elif isinstance(item, ClipChunk):
+            self.write_chunk(item)
+        else:
+            self.logger.warning(f'unexpected item in the clip queue: {item}')
+
+    def start_clip(self, clip_request: ClipRequest):
+        if self.clip is not None:
+            self.logger.warning(f'{self.clip} was cut short. keeping the frames received so far')
+            self.finish_clip()
+        if not clip_request.n_frames:
+            self.logger.warning('received a clip request with no frames. skipping')
+            return
+        self.clip = clip_request
+        self.vid_path = os.path.join(self.vid_dir, f'{clip_request.first_cap_time}_event.mp4')
+
+    def write_chunk(self, chunk: ClipChunk):
+        """decode each frame in the chunk, draw its detections, and stream it straight into the video encoder"""
+        if self.clip is None:
+            self.logger.warning('received clip frames without a clip request. skipping')
+            return
+        for entry in chunk.entries:
+            frame = cv2.imdecode(np.frombuffer(entry.img, np.uint8), cv2.IMREAD_COLOR)
+            if self.video is None:
+                height, width = frame.shape[:2]
+                fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
+                self.video = cv2.VideoWriter(self.vid_path, fourcc, self.clip.frame_rate, (width, height))
+            self.video.write(draw_dets(frame, entry.dets, self.labels, self.pipe_id))
+        if chunk.last:
+            self.finish_clip()
+
+    def finish_clip(self):
+        """close the current clip and, if the request asked for it, send the NOTIFY event"""
+        if self.video is not None:
+            self.video.release()
+            self.logger.info(f'event clip written to {self.vid_path}')
+            if self.clip.notify:
+                self.event_q.safe_put(mptools.EventMessage(self.name, 'NOTIFY',
+                                                           ['SPAWNING_EVENT', self.clip.msg, self.vid_path]))
+        self.clip = None
+        self.video = None
+
+    def shutdown(self):
+        if self.clip is not None:
+            self.finish_clip()
+        self.work_q.close()
+        self.event_q.close()
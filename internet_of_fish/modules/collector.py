@@ -1,4 +1,5 @@
-import logging, os, io, time
+import logging, os, io, time, subprocess, threading
+import numpy as np
 from PIL import Image
 from internet_of_fish.modules import mptools
 from internet_of_fish.modules.utils import gen_utils
@@ -11,37 +12,68 @@ class CollectorWorker(mptools.TimerProcWorker, metaclass=gen_utils.AutologMetacl
 
 
     def init_args(self, args):
-        self.img_q, = args
+        self.img_q = args[0]
+        # when running alongside a detector, the collector is also given a queue through which clips are requested
+        self.clip_trigger_q = args[1] if len(args) > 1 else None
         self.INTERVAL_SECS = self.defs.INTERVAL_SECS
         self.RESOLUTION = (self.defs.H_RESOLUTION, self.defs.V_RESOLUTION)  # pi camera resolution
         self.FRAMERATE = self.defs.FRAMERATE  # pi camera framerate
         self.SPLIT_AM_PM = self.defs.SPLIT_AM_PM
+        self.CAPTURE_FORMAT = self.defs.CAPTURE_FORMAT
+        self.CAPTURE_MODE = self.defs.CAPTURE_MODE
+        self.rate_controller = gen_utils.RateController(self.INTERVAL_SECS, self.INTERVAL_SECS,
+                                                        10 * self.INTERVAL_SECS, self.defs.TARGET_Q_OCCUPANCY)
+        self.logged_interval = self.INTERVAL_SECS
+        self.EVENT_CLIP_PRE_SECS = self.defs.EVENT_CLIP_PRE_SECS
+        self.EVENT_CLIP_POST_SECS = self.defs.EVENT_CLIP_POST_SECS
 
     def startup(self):
         self.cam = self.init_camera()
+        self.init_frame_buffers()
         self.vid_dir = self.defs.PROJ_VID_DIR
-        self.cam.start_recording(self.generate_vid_path())
+        self.h264_buffer = None
+        if self.clip_trigger_q is not None and self.EVENT_CLIP_PRE_SECS:
+            # the buffer has to hold the seconds after the event too, plus some slack so the clip can start on a keyframe
+            buffer_secs = self.EVENT_CLIP_PRE_SECS + self.EVENT_CLIP_POST_SECS + 5
+            self.h264_buffer = picamera.PiCameraCircularIO(self.cam, seconds=buffer_secs)
+        self.pending_clips = []
+        self.vid_file = None
+        self.cam.start_recording(self.recording_output(), format='h264')
         self.split_flag = False if dt.datetime.now().hour < 12 else True
+        self.capture_thread = None
+        if self.CAPTURE_MODE == 'stream':
+            self.start_stream()
 
     def main_func(self):
-        cap_time = gen_utils.current_time_ms()
-        stream = io.BytesIO()
-        self.cam.capture(stream, format='jpeg', use_video_port=True)
-        stream.seek(0)
-        img = Image.open(stream)
-        img.load()
-        put_result = self.img_q.safe_put((cap_time, img))
-        stream.close()
-        if not put_result:
-            self.INTERVAL_SECS += 0.1
-            self.logger.info(f'img_q full, slowing collection interval to {self.INTERVAL_SECS}')
+        if self.capture_thread:
+            # frames are being collected by the capture thread, so only make sure that it is still running
+            if not self.capture_thread.is_alive():
+                raise RuntimeError('capture thread exited unexpectedly')
+        elif self.detect_buffer is not None:
+            self.put_frame(gen_utils.current_time_ms(), self.capture_frame(), self.capture_detect_frame())
+        else:
+            self.put_frame(gen_utils.current_time_ms(), self.capture_frame())
+        if self.clip_trigger_q is not None:
+            self.check_clip_triggers()
         if self.SPLIT_AM_PM and (dt.datetime.now().hour >= 12) and not self.split_flag:
             self.split_recording()
             self.split_flag = True
 
     def shutdown(self):
+        if getattr(self, 'capture_thread', None):
+            self.stop_stream.set()
+            self.capture_thread.join(self.defs.DEFAULT_SHUTDOWN_WAIT_SECS)
+        for timer, clip_args in getattr(self, 'pending_clips', []):
+            # save whatever has been recorded so far, rather than losing the clip entirely
+            if timer.is_alive():
+                timer.cancel()
+                self.save_event_clip(*clip_args)
         self.cam.stop_recording()
+        if self.vid_file:
+            self.vid_file.close()
         self.cam.close()
+        if self.img_q.overflow.dropped.value or self.img_q.overflow.evicted.value:
+            self.logger.info(f'img_q {self.img_q.overflow}')
         self.img_q.safe_put('END')
         self.img_q.close()
         self.event_q.close()
@@ -50,23 +82,232 @@ class CollectorWorker(mptools.TimerProcWorker, metaclass=gen_utils.AutologMetacl
         cam = picamera.PiCamera()
         cam.resolution = self.RESOLUTION
         cam.framerate = self.FRAMERATE
+        # by default, frame timestamps restart from zero with every recording (including each split_recording). In raw
+        # mode they count from the same boot-time origin as cam.timestamp, which is what frame_time relies on
+        cam.clock_mode = 'raw'
         return cam
 
+    def init_frame_buffers(self):
+        """preallocate the arrays that raw captures are written into, so that no per-frame allocation is needed.
+        picamera pads raw captures out to a width that is a multiple of 32 and a height that is a multiple of 16"""
+        width, height = self.RESOLUTION
+        padded_width, padded_height = (width + 31) // 32 * 32, (height + 15) // 16 * 16
+        self.rgb_buffer = np.empty((padded_height, padded_width, 3), dtype=np.uint8)
+        # yuv420 captures hold a full resolution Y plane followed by quarter resolution U and V planes
+        self.yuv_buffer = np.empty((padded_height * 3 // 2, padded_width), dtype=np.uint8)
+        self.jpeg_stream = io.BytesIO()
+        self.capture_output = {'rgb': self.rgb_buffer, 'yuv': self.yuv_buffer}.get(self.CAPTURE_FORMAT,
+                                                                                   self.jpeg_stream)
+        # if the frame queue has room for a detector input, also capture a second stream sized to fit it
+        self.detect_buffer = None
+        detect_shape = getattr(self.img_q, 'detect_shape', None)
+        if detect_shape:
+            self.DETECT_RESOLUTION = (detect_shape[1], detect_shape[0])
+            detect_width, detect_height = self.DETECT_RESOLUTION
+            self.detect_buffer = np.empty(((detect_height + 15) // 16 * 16, (detect_width + 31) // 32 * 32, 3),
+                                          dtype=np.uint8)
+
+    def capture_frame(self):
+        """capture a single RGB frame from the video port, using the capture format specified in the advanced config.
+        When using a raw format, the returned array is a view into a buffer that gets overwritten on the next capture
+        :return: RGB image with shape (V_RESOLUTION, H_RESOLUTION, 3)
+        :rtype: numpy.ndarray
+        """
+        self.cam.capture(self.capture_output, format=self.CAPTURE_FORMAT, use_video_port=True)
+        return self.read_frame()
+
+    def read_frame(self):
+        """convert the contents of self.capture_output, as written by the most recent capture, into an RGB image"""
+        width, height = self.RESOLUTION
+        if self.CAPTURE_FORMAT == 'yuv':
+            cv2.cvtColor(self.yuv_buffer, cv2.COLOR_YUV2RGB_I420, dst=self.rgb_buffer)
+        elif self.CAPTURE_FORMAT == 'jpeg':
+            self.jpeg_stream.seek(0)
+            img = Image.open(self.jpeg_stream)
+            img.load()
+            self.jpeg_stream.seek(0)
+            self.jpeg_stream.truncate()
+            return np.asarray(img)
+        return self.rgb_buffer[:height, :width]
+
+    def capture_detect_frame(self):
+        """capture a single low resolution RGB frame for the detector through a second splitter port, letting the
+        camera's hardware resizer do the downscaling
+        :return: RGB image with shape (height, width, 3), where (width, height) is DETECT_RESOLUTION
+        :rtype: numpy.ndarray
+        """
+        self.cam.capture(self.detect_buffer, format='rgb', use_video_port=True, splitter_port=2,
+                         resize=self.DETECT_RESOLUTION)
+        return self.read_detect_frame()
+
+    def read_detect_frame(self):
+        width, height = self.DETECT_RESOLUTION
+        return self.detect_buffer[:height, :width]
+
+    def put_frame(self, cap_time, *frames):
+        put_result = self.img_q.safe_put((cap_time, *frames))
+        if not put_result:
+            self.logger.debug('img_q full, frame dropped')
+        self.update_rate()
+        return put_result
+
+    def update_rate(self):
+        """let the rate controller pick a new collection interval based on the current depth of the image queue and
+        the detector's recent processing time, and publish the result through the queue"""
+        self.INTERVAL_SECS = self.rate_controller.update(self.img_q.occupancy(), self.img_q.service_secs.value)
+        self.img_q.producer_interval.value = self.INTERVAL_SECS
+        if abs(self.INTERVAL_SECS - self.logged_interval) > 0.1 * self.logged_interval:
+            self.logger.info(f'collection interval adjusted to {self.INTERVAL_SECS:.3f} seconds')
+            self.logged_interval = self.INTERVAL_SECS
+
+    def start_stream(self):
+        """start collecting frames in a dedicated capture thread (see stream_frames)"""
+        # offset between the system clock and the camera's frame clock, both in microseconds
+        self.clock_offset = time.time() * 1e6 - self.cam.timestamp
+        self.stop_stream = threading.Event()
+        self.capture_thread = threading.Thread(target=self.stream_frames, daemon=True)
+        self.capture_thread.start()
+
+    def stream_frames(self):
+        """target of the capture thread. Holds persistent continuous-capture iterators open on the video port, rather
+        than setting up and tearing down a capture for every frame, and samples them against a monotonic schedule of
+        one frame every INTERVAL_SECS. Each frame is timestamped by the camera's frame clock"""
+        frames = self.cam.capture_continuous(self.capture_output, format=self.CAPTURE_FORMAT, use_video_port=True)
+        detect_frames = None
+        if self.detect_buffer is not None:
+            detect_frames = self.cam.capture_continuous(self.detect_buffer, format='rgb', use_video_port=True,
+                                                        splitter_port=2, resize=self.DETECT_RESOLUTION)
+        next_time = time.monotonic()
+        try:
+            while not self.stop_stream.wait(max(0.0, next_time - time.monotonic())):
+                next(frames)
+                cap_time = self.frame_time()
+                if detect_frames:
+                    next(detect_frames)
+                    self.put_frame(cap_time, self.read_frame(), self.read_detect_frame())
+                else:
+                    self.put_frame(cap_time, self.read_frame())
+                # if we fell behind schedule, skip the missed frames rather than trying to catch up
+                next_time = max(next_time + self.INTERVAL_SECS, time.monotonic())
+        except Exception as e:
+            self.logger.error(f'capture thread failed with {e}')
+        finally:
+            frames.close()
+            if detect_frames:
+                detect_frames.close()
+
+    def frame_time(self):
+        """capture time of the most recent frame, according to the camera's frame clock, converted to ms since epoch.
+        Falls back to the system clock if the camera did not provide a timestamp.
+
+        picamera only exposes timestamps through cam.frame, which describes the latest frame seen by the h264 encoder on
+        the recording port rather than the frame capture_continuous just returned. Both ports are fed by the same
+        sensor, so the two are at most a frame or so apart (1 / FRAMERATE seconds), which is accurate enough for
+        staleness checks, latency stats and tracking"""
+        try:
+            frame = self.cam.frame
+        except picamera.PiCameraError:
+            frame = None
+        if frame is None or frame.timestamp is None:
+            return gen_utils.current_time_ms()
+        return int((frame.timestamp + self.clock_offset) // 1000)
+
     def generate_vid_path(self):
         return os.path.join(self.vid_dir, f'{gen_utils.current_time_iso()}.h264')
 
+    def recording_output(self):
+        """output for the main h264 recording. If event clips are enabled, the encoder output goes both to a new video
+        file and to the in-memory h264 buffer that event clips are cut from"""
+        vid_path = self.generate_vid_path()
+        if self.h264_buffer is None:
+            return vid_path
+        self.vid_file = open(vid_path, 'wb')
+        return TeeOutput(self.vid_file, self.h264_buffer)
+
     def split_recording(self):
-        self.cam.split_recording(self.generate_vid_path())
+        old_vid_file = self.vid_file
+        self.cam.split_recording(self.recording_output())
+        if old_vid_file:
+            old_vid_file.close()
+
+    def check_clip_triggers(self):
+        """if the detector has asked for an event clip, schedule the clip to be saved once EVENT_CLIP_POST_SECS more
+        seconds have been recorded"""
+        trigger = self.clip_trigger_q.safe_get(timeout=None)
+        if trigger is None:
+            return
+        if self.h264_buffer is None:
+            self.logger.warning('event clip requested, but the h264 buffer is disabled')
+            return
+        clip_args = (os.path.join(self.vid_dir, f'{gen_utils.current_time_iso()}_event.h264'), trigger.msg)
+        timer = threading.Timer(self.EVENT_CLIP_POST_SECS, self.save_event_clip, args=clip_args)
+        timer.daemon = True
+        timer.start()
+        self.pending_clips = [(t, a) for t, a in self.pending_clips if t.is_alive()] + [(timer, clip_args)]
+
+    def save_event_clip(self, h264_path, msg):
+        """copy the buffered h264 stream, starting from the last keyframe before the event, to h264_path without
+        re-encoding it. Then wrap it in an mp4 container and send the notification
+        :param h264_path: where to save the clip
+        :type h264_path: str
+        :param msg: message to send along with the clip
+        :type msg: str
+        """
+        clip_secs = self.EVENT_CLIP_PRE_SECS + self.EVENT_CLIP_POST_SECS
+        self.h264_buffer.copy_to(h264_path, seconds=clip_secs, first_frame=picamera.PiVideoFrameType.sps_header)
+        vid_path = self.h264_to_mp4(h264_path)
+        self.logger.info(f'event clip saved to {vid_path}')
+        self.event_q.safe_put(mptools.EventMessage(self.name, 'NOTIFY', ['SPAWNING_EVENT', msg, vid_path]))
+
+    def h264_to_mp4(self, h264_path):
+        """remux a raw h264 stream into an mp4 container (no re-encoding), deleting the original if successful
+        :return: path to the mp4, or to the original h264 file if the conversion failed
+        :rtype: str
+        """
+        mp4_path = os.path.splitext(h264_path)[0] + '.mp4'
+        cmnd = ['ffmpeg', '-y', '-v', 'error', '-framerate', str(self.FRAMERATE), '-i', h264_path, '-c', 'copy',
+                mp4_path]
+        try:
+            subprocess.run(cmnd, check=True, timeout=60)
+        except Exception as e:
+            self.logger.warning(f'failed to convert {h264_path} to mp4: {e}')
+            return h264_path
+        os.remove(h264_path)
+        return mp4_path
+
+
+class TeeOutput:
+
+    """file-like object that passes everything written to it on to each of several outputs"""
+
+    def __init__(self, *outputs):
+        self.outputs = outputs
+
+    def write(self, b):
+        for output in self.outputs:
+            output.write(b)
+        return len(b)
+
+    def flush(self):
+        for output in self.outputs:
+            output.flush()
 
 
 class SourceCollectorWorker(CollectorWorker):
 
     """functions like a CollectorWorker, but gathers images from an existing file rather than a camera"""
 
+    # a seek makes the decoder go back to the keyframe before the target and decode forward from there. The keyframe
+    # interval is only an estimate (and can vary within a file), so only seek when the skip spans several of them
+    SEEK_MIN_GOPS = 4
+
     def init_args(self, args):
         self.img_q, self.video_file = args
         self.VIRTUAL_INTERVAL_SECS = self.defs.INTERVAL_SECS
         self.INTERVAL_SECS = 0.1
+        # no real-time constraint on a video file, so let the detector's processing speed set the pace
+        self.rate_controller = gen_utils.RateController(self.INTERVAL_SECS, 0.0, 10.0, self.defs.TARGET_Q_OCCUPANCY)
+        self.logged_interval = self.INTERVAL_SECS
 
     def startup(self):
         if not os.path.exists(self.video_file):
@@ -74,30 +315,80 @@ class SourceCollectorWorker(CollectorWorker):
         self.cam = cv2.VideoCapture(self.video_file)
         self.cap_rate = max(1, int(self.cam.get(cv2.CAP_PROP_FPS) * self.VIRTUAL_INTERVAL_SECS))
         self.logger.log(logging.INFO, f"Collector will add an image to the queue every {self.cap_rate} frame(s)")
+        # seeking forces the decoder back to the previous keyframe, so it only pays off if the frames between samples
+        # span several groups of pictures. Otherwise, decode sequentially and discard the unwanted frames
+        self.gop_size = self.estimate_gop_size()
+        self.seek_frames = bool(self.gop_size) and self.cap_rate - 1 > self.SEEK_MIN_GOPS * self.gop_size
+        self.logger.log(logging.INFO, f"estimated keyframe interval of {self.gop_size} frame(s). Collector will "
+                                      f"{'seek between frames' if self.seek_frames else 'decode sequentially'}")
         self.frame_count = 0
+        self.decode_count = 0
+        self.decode_start = time.time()
         self.active = True
 
     def main_func(self):
         if not self.active:
-            time.sleep(1)
+            self.shutdown_event.wait(1)
             return
         cap_time = gen_utils.current_time_ms()
+        source_frame = int(self.cam.get(cv2.CAP_PROP_POS_FRAMES))
         ret, frame = self.cam.read()
+        self.decode_count += 1
         if ret:
             img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            put_result = self.img_q.safe_put((cap_time, img))
-            while not put_result:
-                self.INTERVAL_SECS += 0.1
-                self.logger.debug(f'img_q full, increasing loop interval to {self.INTERVAL_SECS}')
-                time.sleep(self.INTERVAL_SECS)
-                put_result = self.img_q.safe_put((cap_time, img))
+            # frames from a file should never be dropped, so keep waiting for room in the queue until the put succeeds
+            while not self.img_q.safe_put((cap_time, img, source_frame), timeout=1.0):
+                self.update_rate()
+                if self.shutdown_event.is_set():
+                    return
+            self.update_rate()
             self.frame_count += self.cap_rate
-            self.cam.set(cv2.CAP_PROP_POS_FRAMES, self.frame_count)
+            self.advance()
+            if not (self.frame_count // self.cap_rate) % 100:
+                self.print_info()
         else:
             self.active = False
+            self.print_info()
             self.logger.log(logging.INFO, "VideoCollector entering sleep mode (no more frames to process)")
             self.img_q.safe_put('END')
 
+    def advance(self):
+        """move the capture forward so that the next read returns frame number self.frame_count, either by seeking (for
+        long skips, see SEEK_MIN_GOPS) or by grabbing the frames in between"""
+        if self.seek_frames:
+            self.cam.set(cv2.CAP_PROP_POS_FRAMES, self.frame_count)
+        else:
+            for _ in range(self.cap_rate - 1):
+                # grab decodes the frame without the cost of retrieving and color converting it
+                if not self.cam.grab():
+                    break
+                self.decode_count += 1
+
+    def estimate_gop_size(self, n_packets=600):
+        """estimate the keyframe interval of the source video from the flags of its first n_packets packets
+        :param n_packets: max number of packets to inspect
+        :type n_packets: int
+        :return: estimated number of frames between keyframes, or None if it could not be determined
+        :rtype: int
+        """
+        cmnd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=flags',
+                '-of', 'csv=p=0', '-read_intervals', f'%+#{n_packets}', self.video_file]
+        try:
+            out = subprocess.run(cmnd, capture_output=True, encoding='utf-8', timeout=60)
+        except Exception as e:
+            self.logger.debug(f'failed to probe keyframe interval: {e}')
+            return None
+        keyframes = [i for i, flags in enumerate(out.stdout.split()) if flags.startswith('K')]
+        if len(keyframes) < 2:
+            return None
+        return max(1, round((keyframes[-1] - keyframes[0]) / (len(keyframes) - 1)))
+
+    def print_info(self):
+        elapsed = time.time() - self.decode_start
+        if elapsed > 0:
+            self.logger.info(f'{self.decode_count} frames decoded at {self.decode_count / elapsed:.1f} frames per '
+                             f'second. currently at frame {self.frame_count}')
+
     def locate_video(self):
         path_elements = [self.defs.HOME_DIR,
                          * os.path.relpath(self.defs.DATA_DIR, self.defs.HOME_DIR).split(os.sep),
@@ -123,6 +414,11 @@ class SourceCollectorWorker(CollectorWorker):
 
 class SimpleCollectorWorker(CollectorWorker):
 
+    def init_args(self, args):
+        super().init_args(args)
+        # this collector only records video, so there are never any frames to stream
+        self.CAPTURE_MODE = 'timer'
+
     def main_func(self):
         time.sleep(5)
         if self.SPLIT_AM_PM and (dt.datetime.now().hour >= 12) and not self.split_flag:
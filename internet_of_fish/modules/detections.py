@@ -0,0 +1,193 @@
+import os
+from glob import glob
+
+import numpy as np
+
+# compact, fixed-width representation of a set of detections. One row per detection, with the box in the coordinates of
+# the full frame. Used in place of lists of inference.Object namedtuples everywhere after inference, so that
+# filtering and box tests can be done in bulk
+DET_DTYPE = np.dtype([('id', np.int32), ('score', np.float32),
+                      ('xmin', np.float32), ('ymin', np.float32), ('xmax', np.float32), ('ymax', np.float32)])
+BOX_FIELDS = ['xmin', 'ymin', 'xmax', 'ymax']
+
+
+def empty():
+    """a detection array with no detections"""
+    return np.empty(0, dtype=DET_DTYPE)
+
+
+def from_objects(objs, offset=(0, 0)):
+    """
+    convert detections from the format returned by the inference backends
+    :param objs: detections, as returned by inference.InferenceBackend.detect
+    :type objs: list[inference.Object]
+    :param offset: (x, y) shift added to each box, e.g., to map boxes from a crop back onto the full frame
+    :type offset: tuple[int, int]
+    :return: detection array, in the same order as objs
+    :rtype: np.ndarray
+    """
+    dets = np.array([(obj.id, obj.score, *obj.bbox) for obj in objs], dtype=DET_DTYPE)
+    if offset != (0, 0):
+        dets['xmin'] += offset[0]
+        dets['xmax'] += offset[0]
+        dets['ymin'] += offset[1]
+        dets['ymax'] += offset[1]
+    return dets
+
+
+def boxes(dets):
+    """(xmin, ymin, xmax, ymax) of each detection, as a float array with shape (n, 4)"""
+    return np.stack([dets[field] for field in BOX_FIELDS], axis=-1).astype(np.float64)
+
+
+def select(dets, det_id, top_k=None):
+    """
+    the highest scoring detections of a single class
+    :param det_id: class id to keep
+    :type det_id: int
+    :param top_k: maximum number of detections to keep. If None, keep them all
+    :type top_k: int
+    :return: detections of class det_id, in descending order of score
+    :rtype: np.ndarray
+    """
+    dets = dets[dets['id'] == det_id]
+    return dets[np.argsort(-dets['score'], kind='stable')][:top_k]
+
+
+def containment(boxes_, container):
+    """
+    fraction of the area of each box that lies within a container box
+    :param boxes_: array of (xmin, ymin, xmax, ymax) boxes, with shape (n, 4)
+    :type boxes_: np.ndarray
+    :param container: (xmin, ymin, xmax, ymax) of the container
+    :type container: np.ndarray
+    :return: array of fractions, with shape (n,)
+    :rtype: np.ndarray
+    """
+    inter_width = np.clip(np.minimum(boxes_[:, 2], container[2]) - np.maximum(boxes_[:, 0], container[0]), 0, None)
+    inter_height = np.clip(np.minimum(boxes_[:, 3], container[3]) - np.maximum(boxes_[:, 1], container[1]), 0, None)
+    areas = (boxes_[:, 2] - boxes_[:, 0]) * (boxes_[:, 3] - boxes_[:, 1])
+    return np.where(areas > 0, inter_width * inter_height / np.maximum(areas, 1e-9), 0.0)
+
+
+def inside(boxes_, container, min_frac=1.0):
+    """boolean mask of the boxes that have at least min_frac of their area within the container box (see
+    containment). The comparison is tolerant of floating point error, so boxes that exactly fit count as inside"""
+    frac = containment(boxes_, container)
+    return (frac >= min_frac) | np.isclose(frac, min_frac)
+
+
+# on-disk record for the detection log. One row per detection, tagged with the capture time of its frame. Frames that
+# were processed but had no detections get a single row with an id of NO_DETS, and frames where inference was skipped
+# (e.g., by the motion gate) get a single row with an id of NOT_INFERRED, so that gaps in the log (frames that never
+# reached the detector) can be told apart from empty or skipped frames. Byte order is fixed, so logs written on the pi
+# can be read anywhere
+LOG_DTYPE = np.dtype([('cap_time', '<i8'), ('id', '<i4'), ('score', '<f4'),
+                      ('xmin', '<f4'), ('ymin', '<f4'), ('xmax', '<f4'), ('ymax', '<f4')])
+LOG_EXT = '.dets'
+NO_DETS = -1
+NOT_INFERRED = -2
+
+
+class DetectionLog:
+
+    def __init__(self, log_dir, chunk_records=1000000, buffer_records=8192):
+        """
+        append-only binary log of every processed frame's detections, made of fixed-width LOG_DTYPE records so that it
+        can be memory-mapped (see load_log). Records are collected in memory and written in large blocks, and the log
+        is split into chunks of at most chunk_records records, each named after the cap_time of its first record
+
+        :param log_dir: directory the chunks are written into
+        :type log_dir: str
+        :param chunk_records: maximum number of records per chunk
+        :type chunk_records: int
+        :param buffer_records: number of records held in memory between writes
+        :type buffer_records: int
+        """
+        self.log_dir = log_dir
+        self.chunk_records = chunk_records
+        self.buffer = np.zeros(buffer_records, dtype=LOG_DTYPE)
+        self.n_buffered = 0
+        self.chunk_path = None
+        self.chunk_file = None
+        self.n_chunk_records = 0
+        os.makedirs(log_dir, exist_ok=True)
+
+    def write(self, cap_time, dets, inferred=True):
+        """
+        :param cap_time: capture time of the frame the detections came from
+        :type cap_time: int
+        :param dets: detections for the frame (see DET_DTYPE), which may be empty
+        :type dets: np.ndarray
+        :param inferred: False if inference was not run on the frame, in which case dets is ignored and a single
+            NOT_INFERRED row is written
+        :type inferred: bool
+        """
+        if not inferred:
+            dets = np.array([(NOT_INFERRED, 0, 0, 0, 0, 0)], dtype=DET_DTYPE)
+        elif not len(dets):
+            dets = np.array([(NO_DETS, 0, 0, 0, 0, 0)], dtype=DET_DTYPE)
+        if self.n_buffered + len(dets) > len(self.buffer):
+            self.flush()
+            if len(dets) > len(self.buffer):
+                self.buffer = np.zeros(len(dets), dtype=LOG_DTYPE)
+        rows = self.buffer[self.n_buffered:self.n_buffered + len(dets)]
+        rows['cap_time'] = cap_time
+        for field in DET_DTYPE.names:
+            rows[field] = dets[field]
+        self.n_buffered += len(dets)
+
+    def flush(self):
+        """write the buffered records to the current chunk, starting a new chunk if it is full"""
+        start = 0
+        while start < self.n_buffered:
+            if self.chunk_file is None or self.n_chunk_records >= self.chunk_records:
+                self.open_chunk(self.buffer[start]['cap_time'])
+            stop = min(self.n_buffered, start + self.chunk_records - self.n_chunk_records)
+            self.chunk_file.write(self.buffer[start:stop].tobytes())
+            self.n_chunk_records += stop - start
+            start = stop
+        if self.chunk_file is not None:
+            self.chunk_file.flush()
+        self.n_buffered = 0
+
+    def open_chunk(self, cap_time):
+        if self.chunk_file is not None:
+            self.chunk_file.close()
+        self.chunk_path = os.path.join(self.log_dir, f'{cap_time}_detections{LOG_EXT}')
+        self.chunk_file = open(self.chunk_path, 'ab')
+        self.n_chunk_records, partial_bytes = divmod(self.chunk_file.tell(), LOG_DTYPE.itemsize)
+        if partial_bytes:
+            # drop a partial record left by an interrupted write, so that new records stay aligned
+            self.chunk_file.truncate(self.n_chunk_records * LOG_DTYPE.itemsize)
+            self.chunk_file.seek(0, os.SEEK_END)
+
+    def close(self):
+        self.flush()
+        if self.chunk_file is not None:
+            self.chunk_file.close()
+            self.chunk_file = None
+
+
+def load_log(path):
+    """
+    memory-map a detection log chunk, without reading it into memory. A partial record at the end of the file (e.g.,
+    from a power cut mid-write) is ignored
+    :param path: path to a chunk written by DetectionLog
+    :type path: str
+    :return: read-only array of LOG_DTYPE records
+    :rtype: np.memmap
+    """
+    n_records = os.path.getsize(path) // LOG_DTYPE.itemsize
+    if not n_records:
+        return np.empty(0, dtype=LOG_DTYPE)
+    return np.memmap(path, dtype=LOG_DTYPE, mode='r', shape=(n_records,))
+
+
+def load_logs(log_dir):
+    """memory-map every chunk in a directory (see load_log)
+    :return: one array per chunk, in the order they were written
+    :rtype: list[np.memmap]
+    """
+    paths = sorted(glob(os.path.join(log_dir, f'*{LOG_EXT}')), key=lambda p: int(os.path.basename(p).split('_')[0]))
+    return [load_log(path) for path in paths]
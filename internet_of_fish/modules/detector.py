@@ -1,170 +1,766 @@
-import os, logging, time
-from collections import namedtuple
+import os, logging, time, queue, threading
+from collections import namedtuple, deque
 
-from PIL import Image, ImageDraw
-from glob import glob
-from numpy import isclose
+import cv2
+import numpy as np
 
-from pycoral.adapters import common
-from pycoral.adapters import detect
-from pycoral.utils.dataset import read_label_file
-from pycoral.utils.edgetpu import make_interpreter
-
-import internet_of_fish.modules.advanced_utils
 from internet_of_fish.modules import mptools
+from internet_of_fish.modules import inference
+from internet_of_fish.modules import detections
+from internet_of_fish.modules import tracker
+from internet_of_fish.modules import clip_writer
 from internet_of_fish.modules.utils import gen_utils
 
 BufferEntry = namedtuple('BufferEntry', ['cap_time', 'img', 'dets'])
+DetectionJob = namedtuple('DetectionJob', ['cap_time', 'img', 'inputs', 'n_skipped', 'dets', 'source_frame', 'frame',
+                                           'fresh'])
+
+
+def detect_resolution(resolution, input_size):
+    """largest (width, height) with the same aspect ratio as resolution that fits inside input_size. Matches the
+    scaling applied by DetectorWorker.resize_input, so images of this size go into the interpreter
+    without any further resizing"""
+    scale = min(input_size[0] / resolution[0], input_size[1] / resolution[1])
+    return int(resolution[0] * scale), int(resolution[1] * scale)
+
+
+def tile_regions(region, grid_size, overlap):
+    """
+    split a region into a grid_size x grid_size grid of overlapping tiles
+    :param region: (xmin, ymin, xmax, ymax) of the area to cover
+    :type region: tuple[int, int, int, int]
+    :param grid_size: number of tiles along each side of the grid
+    :type grid_size: int
+    :param overlap: fraction of each tile's width (or height) that it shares with its neighbor
+    :type overlap: float
+    :return: (xmin, ymin, xmax, ymax) of each tile, row by row
+    :rtype: list[tuple[int, int, int, int]]
+    """
+    xmin, ymin, xmax, ymax = region
+    tile_width = (xmax - xmin) / (grid_size - (grid_size - 1) * overlap)
+    tile_height = (ymax - ymin) / (grid_size - (grid_size - 1) * overlap)
+    tiles = []
+    for row in range(grid_size):
+        for col in range(grid_size):
+            x0 = xmin + col * tile_width * (1 - overlap)
+            y0 = ymin + row * tile_height * (1 - overlap)
+            tiles.append((int(round(x0)), int(round(y0)),
+                          min(xmax, int(round(x0 + tile_width))), min(ymax, int(round(y0 + tile_height)))))
+    return tiles
+
+
+def non_max_suppression(dets, iou_thresh=0.5):
+    """
+    class-aware non-maximum suppression, vectorized with numpy. Used to merge the detections from overlapping tiles
+    :param dets: detections, in any order (see detections.DET_DTYPE)
+    :type dets: np.ndarray
+    :param iou_thresh: a detection is suppressed if its IoU with a higher scoring detection of the same class is
+        greater than this value
+    :type iou_thresh: float
+    :return: the remaining detections, in descending order of score
+    :rtype: np.ndarray
+    """
+    if not len(dets):
+        return dets
+    boxes = detections.boxes(dets)
+    scores, ids = dets['score'], dets['id']
+    # shift each class into its own area of coordinate space, so that boxes of different classes never overlap
+    boxes += (ids * (boxes.max() + 1))[:, None]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-scores)
+    keep = []
+    while order.size:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        inter_width = np.clip(np.minimum(boxes[best, 2], boxes[rest, 2]) - np.maximum(boxes[best, 0], boxes[rest, 0]),
+                              0, None)
+        inter_height = np.clip(np.minimum(boxes[best, 3], boxes[rest, 3]) - np.maximum(boxes[best, 1], boxes[rest, 1]),
+                               0, None)
+        inter = inter_width * inter_height
+        iou = inter / (areas[best] + areas[rest] - inter)
+        order = rest[iou <= iou_thresh]
+    return dets[keep]
+
+
+def encode_jpeg(frame, quality=90):
+    """compress an RGB image, given as a numpy array, to jpeg bytes"""
+    _, jpeg = cv2.imencode('.jpg', cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return jpeg.tobytes()
+
+
+class EventBuffer:
+
+    def __init__(self, max_bytes):
+        """
+        ring buffer of the most recent frames and their detections, used to build a video when an event occurs.
+
+        frames are stored as jpeg bytes (see encode_jpeg) and are only decoded if an event actually fires, so the
+        buffer is sized by the memory it uses rather than by a number of frames. Once the total size of the stored
+        frames exceeds max_bytes, the oldest frames are dropped
+        :param max_bytes: memory budget for the stored frames, in bytes
+        :type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self.entries = deque()
+        self.nbytes = 0
+
+    def append(self, buffer_entry: BufferEntry):
+        self.entries.append(buffer_entry)
+        self.nbytes += len(buffer_entry.img)
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            self.nbytes -= len(self.entries.popleft().img)
+
+    def flush(self):
+        """empty the buffer
+        :return: the entries that were in the buffer, oldest first
+        :rtype: list[BufferEntry]
+        """
+        entries = list(self.entries)
+        self.entries.clear()
+        self.nbytes = 0
+        return entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        return self.entries[index]
+
 
 class HitCounter:
 
     def __init__(self):
         self.hits = 0
 
-    def increment(self):
-        self.hits += 1
+    def increment(self, n=1):
+        self.hits += n
 
-    def decrement(self):
-        if self.hits > 0:
-            self.hits -= 1
+    def decrement(self, n=1):
+        self.hits = max(0, self.hits - n)
 
     def reset(self):
         self.hits = 0
 
 
+class MotionGate:
+
+    def __init__(self, threshold, max_skip_ratio=0.9, size=(128, 96), pixel_delta=10, alpha=0.05):
+        """
+        cheap frame-differencing motion detector, used to decide whether a frame is worth running inference on.
+
+        each frame is converted to a heavily downsampled grayscale image and compared against a running-average
+        background. The motion score is the fraction of pixels that differ from the background by more than
+        pixel_delta gray levels
+        :param threshold: frames with a motion score at or below this value are considered static
+        :type threshold: float
+        :param max_skip_ratio: upper limit on the fraction of frames that can be skipped. Ensures that inference still
+                               runs periodically, even on a completely static scene
+        :type max_skip_ratio: float
+        :param size: (width, height) of the downsampled image
+        :type size: tuple[int, int]
+        :param pixel_delta: gray level difference above which a pixel is considered to have changed
+        :type pixel_delta: int
+        :param alpha: weight given to each new frame when updating the background
+        :type alpha: float
+        """
+        self.threshold = threshold
+        self.max_consecutive_skips = int(round(1 / (1 - max_skip_ratio))) - 1 if max_skip_ratio < 1 else float('inf')
+        self.size = size
+        self.pixel_delta = pixel_delta
+        self.alpha = alpha
+        self.background = None
+        self.score = 0.0
+        self.checked = 0
+        self.skipped = 0
+        self.consecutive_skips = 0
+
+    def check(self, frame):
+        """
+        update the background with a new frame and decide whether inference is needed
+        :param frame: RGB image
+        :type frame: numpy.ndarray
+        :return: True if inference should run on this frame, False if it can be skipped
+        :rtype: bool
+        """
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY).astype(np.float32)
+        self.checked += 1
+        if self.background is None:
+            self.background = small
+            return True
+        self.score = float(np.mean(np.abs(small - self.background) > self.pixel_delta))
+        cv2.accumulateWeighted(small, self.background, self.alpha)
+        if self.score > self.threshold or self.consecutive_skips >= self.max_consecutive_skips:
+            self.consecutive_skips = 0
+            return True
+        self.consecutive_skips += 1
+        self.skipped += 1
+        return False
+
+    @property
+    def skip_ratio(self):
+        return self.skipped / self.checked if self.checked else 0.0
+
+
+class PipeCache:
+
+    def __init__(self, warmup_frames=20, revalidate_secs=900, min_iou=0.5):
+        """
+        learns a stable bounding box for the pipe, which essentially never moves, so that a single frame where the
+        pipe is missed (e.g., because fish are covering it) doesn't break the hit check.
+
+        the cached box is the median of the pipe detections from a warm-up window of warmup_frames frames. Every
+        revalidate_secs, a new window is collected, and the cached box is replaced if the new median no longer overlaps
+        it closely
+        :param warmup_frames: number of frames in each warm-up/revalidation window
+        :type warmup_frames: int
+        :param revalidate_secs: time between revalidation windows, in seconds
+        :type revalidate_secs: float
+        :param min_iou: if the new median box has an IoU below this value with the cached box, the pipe is assumed to
+            have moved
+        :type min_iou: float
+        """
+        self.warmup_frames = warmup_frames
+        self.revalidate_ms = revalidate_secs * 1000
+        self.min_iou = min_iou
+        self.det = None
+        self.samples = []
+        self.next_validation = 0
+
+    def collecting(self, cap_time):
+        """True while the cache is collecting pipe detections, either for the initial warm-up or for a revalidation.
+        During these windows, inference should run on the full frame"""
+        return self.det is None or cap_time >= self.next_validation
+
+    def update(self, pipe_det, cap_time):
+        """
+        record the pipe detection for a frame, if a window is being collected, and update the cached box at the end
+        of the window
+        :param pipe_det: pipe detection for the frame (see DetectorWorker.filter_dets), which may be empty
+        :type pipe_det: np.ndarray
+        :param cap_time: capture time of the frame
+        :type cap_time: int
+        :return: True if the cached box changed
+        :rtype: bool
+        """
+        if not self.collecting(cap_time):
+            return False
+        self.samples.append(pipe_det[:1])
+        if len(self.samples) < self.warmup_frames:
+            return False
+        found = np.concatenate(self.samples)
+        self.samples = []
+        if len(found) < self.warmup_frames / 2:
+            # too unreliable to update the cache. If a box is already cached, keep it until the next revalidation
+            if self.det is not None:
+                self.next_validation = cap_time + self.revalidate_ms
+            return False
+        self.next_validation = cap_time + self.revalidate_ms
+        median_box = np.median(detections.boxes(found), axis=0)
+        if self.det is not None and tracker.iou_matrix(median_box[None], self.bbox[None])[0, 0] >= self.min_iou:
+            return False
+        self.det = np.array([(found['id'][0], np.median(found['score']), *median_box)], dtype=detections.DET_DTYPE)
+        return True
+
+    @property
+    def bbox(self):
+        """(xmin, ymin, xmax, ymax) of the cached pipe box"""
+        return detections.boxes(self.det)[0]
+
+    def roi(self, frame_width, frame_height, margin):
+        """
+        region of interest around the cached pipe box
+        :param margin: padding added to each side of the box, as a fraction of the box width or height
+        :type margin: float
+        :return: (xmin, ymin, xmax, ymax) of the region, clipped to the frame
+        :rtype: tuple[int, int, int, int]
+        """
+        xmin, ymin, xmax, ymax = self.bbox
+        pad_x, pad_y = margin * (xmax - xmin), margin * (ymax - ymin)
+        return (max(0, int(xmin - pad_x)), max(0, int(ymin - pad_y)),
+                min(frame_width, int(xmax + pad_x)), min(frame_height, int(ymax + pad_y)))
+
+
 class DetectorWorker(mptools.QueueProcWorker, metaclass=gen_utils.AutologMetaclass):
 
 
     def init_args(self, args):
-        self.work_q, = args
+        self.work_q, self.clip_q, self.clip_trigger_q, self.inference_client = args
+        # if the collector keeps a buffer of the h264 stream, it saves full framerate event clips and notifies the user
+        self.H264_CLIPS = self.clip_trigger_q is not None and bool(self.defs.EVENT_CLIP_PRE_SECS)
         self.MODELS_DIR = self.defs.MODELS_DIR
         self.DATA_DIR = self.defs.DATA_DIR
         self.HIT_THRESH = self.defs.HIT_THRESH_SECS
-        self.IMG_BUFFER = self.defs.IMG_BUFFER_SECS
+        self.IMG_BUFFER_BYTES = self.defs.IMG_BUFFER_BYTES
+        # frames from a source video should all be processed, no matter how far behind the detector falls
+        self.LATEST_FRAME_WINS = self.defs.LATEST_FRAME_WINS and not self.metadata['source']
+        self.MAX_FRAME_AGE_SECS = self.defs.MAX_FRAME_AGE_SECS
+        self.PIPELINED = self.defs.DETECT_PIPELINE
+        self.PIPELINE_DEPTH = 2
 
     def startup(self):
         self.mock_hit_flag = False
         self.max_fish = self.metadata['n_fish'] if self.metadata['n_fish'] else self.defs.MAX_DETS
-        self.img_dir = self.defs.PROJ_IMG_DIR
+        self.source_writer = None
+        if self.metadata['source']:
+            self.source_writer = self.make_source_writer()
 
-        model_path = glob(os.path.join(self.MODELS_DIR, self.metadata['model_id'], '*.tflite'))[0]
-        label_path = glob(os.path.join(self.MODELS_DIR, self.metadata['model_id'], '*.txt'))[0]
-        self.interpreter = make_interpreter(model_path)
-        self.interpreter.allocate_tensors()
+        if self.inference_client is not None:
+            # the model is already loaded by the host's inference server, so only the labels are needed here
+            self.backend = self.inference_client
+            _, label_path = inference.locate_model(self.MODELS_DIR, self.metadata['model_id'])
+        else:
+            self.backend, label_path = inference.make_backend(self.MODELS_DIR, self.metadata['model_id'],
+                                                              self.defs.INFERENCE_BACKEND, self.defs.CPU_THREADS)
+        self.logger.info(f'running inference with the {self.backend}')
+        self.input_size = self.backend.input_size
 
-        self.labels = read_label_file(label_path)
+        self.labels = inference.read_labels(label_path)
         self.ids = {val: key for key, val in self.labels.items()}
 
         self.hit_counter = HitCounter()
+        self.tracker = None
+        if self.defs.HIT_MODE == 'tracker':
+            self.tracker = tracker.Tracker()
+        self.DETECT_EVERY_N_FRAMES = self.defs.DETECT_EVERY_N_FRAMES if self.tracker else 1
+        self.frames_seen = 0
+        self.last_cap_time = None
         self.avg_timer = gen_utils.Averager()
-        self.buffer = []
+        self.service_time = None
+        self.stage_times = {}
+        self.buffer = EventBuffer(self.IMG_BUFFER_BYTES)
         self.loop_counter = 0
+        self.last_hit_flag = False
+        self.frames_dropped = 0
+        self.latency_timer = gen_utils.Averager()
+        self.max_latency = 0
+        self.motion_gate = None
+        if self.defs.MOTION_THRESH is not None:
+            self.motion_gate = MotionGate(self.defs.MOTION_THRESH, self.defs.MOTION_MAX_SKIP_RATIO)
+        self.last_dets = None
+        self.pipe_cache = None
+        if self.defs.PIPE_CACHE:
+            self.pipe_cache = PipeCache(self.defs.PIPE_CACHE_WARMUP_FRAMES, self.defs.PIPE_CACHE_REVALIDATE_SECS)
+        self.PIPE_ROI_MARGIN = self.defs.PIPE_ROI_MARGIN
+        # a grid size below 1 (from a config written before it was validated) means no tiling
+        self.TILE_GRID_SIZE = max(1, self.defs.TILE_GRID_SIZE)
+        self.TILE_OVERLAP = self.defs.TILE_OVERLAP
+        self.TILE_BUDGET_SECS = self.defs.TILE_BUDGET_SECS
+        self.TILE_NMS_IOU = 0.5
+        self.tile_layout = None
+        self.tile_dets = {}
+        # one timer per tile index, created up front. The pipeline threads read this dict while the inference thread
+        # updates it, so its keys must never change after startup
+        self.tile_timers = {tile: gen_utils.Averager() for tile in range(self.TILE_GRID_SIZE ** 2)}
+        self.next_tile = 0
+        self.detection_log = None
+        if self.defs.DETECTION_LOG:
+            self.detection_log = detections.DetectionLog(self.defs.PROJ_DETS_DIR, self.defs.DETECTION_LOG_CHUNK_RECORDS)
+        self.inference_failures = 0
+        self.pipeline_error = None
+        self.pipeline_threads = []
+        if self.PIPELINED:
+            self.start_pipeline()
 
     def main_func(self, q_item):
-        cap_time, img = q_item
-        if img == 'MOCK_HIT':
+        if self.pipeline_error:
+            raise RuntimeError('detection pipeline failed') from self.pipeline_error
+        n_skipped = 0
+        if self.LATEST_FRAME_WINS:
+            q_item, n_skipped = self.skip_stale_frames(q_item)
+        if isinstance(q_item, tuple) and isinstance(q_item[1], str) and q_item[1] == 'MOCK_HIT':
             self.mock_hit_flag = True
             return
-        dets = self.detect(img)
-        fish_dets, pipe_det = self.filter_dets(dets)
-        self.buffer.append(BufferEntry(cap_time, img, fish_dets + pipe_det))
-        if self.metadata['source']:
-            self.overlay_boxes(self.buffer[-1])
-        hit_flag = self.check_for_hit(fish_dets, pipe_det)
-        self.hit_counter.increment() if hit_flag else self.hit_counter.decrement()
-        if self.mock_hit_flag or (self.hit_counter.hits >= self.HIT_THRESH):
+        if self.PIPELINED:
+            # blocks while the pipeline is full, which leaves frames waiting in the work queue for skip_stale_frames
+            self.stage_qs[0].put((q_item, n_skipped))
+            return
+        job = self.preprocess((q_item, n_skipped))
+        self.postprocess(self.run_inference(job))
+
+    def preprocess(self, pipeline_item):
+        """first detection stage: pull the frame out of the queue item, run the motion gate, resize the frame to fit
+        the interpreter input, and compress it for the event buffer.
+        :param pipeline_item: work queue item, and the number of stale frames that were skipped to get to it
+        :type pipeline_item: tuple[Union[mptools.FrameRef, tuple], int]
+        :return: job to pass to the inference stage
+        :rtype: DetectionJob
+        """
+        start = time.time()
+        q_item, n_skipped = pipeline_item
+        if isinstance(q_item, mptools.FrameRef):
+            # frame lives in shared memory, so resize and compress straight from the view instead of copying it out
+            cap_time, frame = q_item.cap_time, self.work_q.view(q_item)
+            # the collector may also have stored a copy already downscaled by the camera to fit the interpreter input
+            detect_frame = self.work_q.detect_view(q_item) if self.work_q.detect_shape else None
+            inputs = self.prepare_inputs(cap_time, frame, detect_frame)
+            img = encode_jpeg(frame)
+            self.work_q.release(q_item)
+            source_frame, frame = None, None
+        else:
+            cap_time, img, source_frame = q_item if len(q_item) == 3 else (*q_item, None)
+            frame = np.asarray(img)
+            inputs = self.prepare_inputs(cap_time, frame)
+            img = encode_jpeg(frame)
+            # source mode keeps the raw frame so that the annotated copy can go straight into the output video
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR) if self.source_writer else None
+        self.update_stage_time('preprocess', time.time() - start)
+        return DetectionJob(cap_time, img, inputs, n_skipped, None, source_frame, frame, False)
+
+    def run_inference(self, job):
+        """second detection stage: run the interpreter on each resized tile of the frame, and merge the results with
+        those cached for any tiles that were not scheduled this frame (see prepare_inputs). If the motion gate skipped
+        the frame, the detections from the previous frame are reused instead"""
+        start = time.time()
+        if job.inputs is not None:
+            layout, tile_inputs = job.inputs
+            if layout != self.tile_layout:
+                # the tiles now cover a different area, so the detections cached for the old tiles no longer apply
+                self.tile_dets = {}
+                self.tile_layout = layout
+            for tile, resized, scale, offset in tile_inputs:
+                tile_start = time.time()
+                self.tile_dets[tile] = self.invoke(resized, scale, offset)
+                self.tile_timers[tile].update(time.time() - tile_start)
+            if len(self.tile_dets) == 1:
+                self.last_dets, = self.tile_dets.values()
+            else:
+                all_dets = np.concatenate(list(self.tile_dets.values()))
+                self.last_dets = non_max_suppression(all_dets, self.TILE_NMS_IOU)
+        elif self.last_dets is None:
+            self.last_dets = detections.empty()
+        self.update_stage_time('inference', time.time() - start)
+        return job._replace(dets=self.last_dets, fresh=job.inputs is not None)
+
+    def postprocess(self, job):
+        """final detection stage: filter the detections, update the buffer and hit counter, and handle any events"""
+        start = time.time()
+        if self.detection_log:
+            # frames that reuse the previous detections (see run_inference) are logged as not inferred
+            self.detection_log.write(job.cap_time, job.dets, inferred=job.fresh)
+        fish_dets, pipe_det = self.filter_dets(job.dets)
+        if self.pipe_cache:
+            if self.pipe_cache.update(pipe_det, job.cap_time):
+                self.logger.info(f'cached pipe location updated to {self.pipe_cache.bbox.round(1).tolist()}')
+            if self.pipe_cache.det is not None:
+                pipe_det = self.pipe_cache.det
+        frame_dets = np.concatenate([fish_dets, pipe_det])
+        self.buffer.append(BufferEntry(job.cap_time, job.img, frame_dets))
+        if self.source_writer and job.frame is not None:
+            annotated = clip_writer.draw_dets(job.frame, frame_dets, self.labels, self.ids['pipe'])
+            self.source_writer.write(annotated, job.cap_time, job.source_frame)
+        if self.tracker:
+            hit = self.check_for_tracked_hit(job, fish_dets, pipe_det)
+        else:
+            hit = self.check_for_counted_hit(job, fish_dets, pipe_det)
+        self.record_latency(job.cap_time)
+        if self.mock_hit_flag or hit:
             self.mock_hit_flag = False
-            self.logger.info(f"Hit counter reached {self.hit_counter.hits}, possible spawning event")
-            img_paths = [self.overlay_boxes(be) for be in self.buffer]
-            vid_path = self.jpgs_to_mp4(img_paths)
             msg = f'possible spawning event in {self.metadata["tank_id"]} at {gen_utils.current_time_iso()}'
-            self.event_q.safe_put(mptools.EventMessage(self.name, 'NOTIFY', ['SPAWNING_EVENT', msg, vid_path]))
+            if self.H264_CLIPS:
+                self.clip_trigger_q.safe_put(mptools.EventMessage(self.name, 'SAVE_CLIP', msg))
+            # the annotated clip is built in another process, so detection carries on uninterrupted
+            clip_request = clip_writer.ClipRequest(msg, self.buffer.flush(), 1 / self.defs.INTERVAL_SECS,
+                                                   notify=not self.H264_CLIPS)
+            for message in clip_request.split():
+                if not self.clip_q.safe_put(message, timeout=1.0):
+                    self.logger.warning(f'clip queue full, {clip_request} cut short')
+                    break
             self.hit_counter.reset()
-            self.buffer = []
-        if len(self.buffer) > self.IMG_BUFFER:
-            self.buffer.pop(0)
+            if self.tracker:
+                self.tracker.reset_dwell()
         self.loop_counter += 1
+        self.update_stage_time('postprocess', time.time() - start)
+        self.report_service_time()
         self.print_info()
 
+    def check_for_counted_hit(self, job, fish_dets, pipe_det):
+        """update the hit counter with the current frame (see check_for_hit)
+        :return: True if the hit counter has reached HIT_THRESH
+        :rtype: bool
+        """
+        hit_flag = self.check_for_hit(fish_dets, pipe_det)
+        # skipped frames are assumed to match the processed frames on either side of them, but only when those agree
+        weight = 1 + job.n_skipped if hit_flag == self.last_hit_flag else 1
+        self.hit_counter.increment(weight) if hit_flag else self.hit_counter.decrement(weight)
+        self.last_hit_flag = hit_flag
+        if self.hit_counter.hits >= self.HIT_THRESH:
+            self.logger.info(f"Hit counter reached {self.hit_counter.hits}, possible spawning event")
+            return True
+        return False
+
+    def check_for_tracked_hit(self, job, fish_dets, pipe_det):
+        """update the fish tracks with the current frame, propagating them forward if no new detections were made,
+        and check how long each fish has been inside the pipe
+        :return: True if at least two fish have been inside the pipe for HIT_THRESH seconds
+        :rtype: bool
+        """
+        if job.fresh:
+            self.tracker.update(fish_dets, job.cap_time)
+        else:
+            self.tracker.propagate(job.cap_time)
+        dt = 0.0 if self.last_cap_time is None else (job.cap_time - self.last_cap_time) / 1000
+        self.last_cap_time = job.cap_time
+        if len(pipe_det):
+            self.tracker.update_dwell(detections.boxes(pipe_det)[0], dt)
+        if self.tracker.n_dwelling(self.HIT_THRESH) >= 2:
+            dwell_times = sorted((track.dwell_secs for track in self.tracker.confirmed_tracks), reverse=True)
+            self.logger.info(f'fish dwell times in pipe reached {dwell_times[:2]}s, possible spawning event')
+            return True
+        return False
+
+    def start_pipeline(self):
+        """start one thread per detection stage, connected by small bounded queues. Each stage has a single thread and
+        the queues are FIFO, so frames reach the postprocess stage (and therefore the buffer and hit counter) in the
+        order they were captured"""
+        self.stage_qs = [queue.Queue(maxsize=self.PIPELINE_DEPTH) for _ in range(3)]
+        stages = [self.preprocess, self.run_inference, self.postprocess]
+        out_qs = self.stage_qs[1:] + [None]
+        self.pipeline_threads = [
+            threading.Thread(target=self.run_stage, args=(stage, in_q, out_q), name=stage.__name__, daemon=True)
+            for stage, in_q, out_q in zip(stages, self.stage_qs, out_qs)]
+        for thread in self.pipeline_threads:
+            thread.start()
+
+    def run_stage(self, stage_func, in_q, out_q):
+        """target of each pipeline thread. Applies stage_func to each item from in_q and passes the result to out_q.
+        None marks the end of the stream, and is passed along before the thread exits. After an error the stage keeps
+        consuming (and discarding) items so that the stages upstream of it never block, and main_func raises the error
+        the next time it is called"""
+        while True:
+            item = in_q.get()
+            if item is None:
+                break
+            if self.pipeline_error:
+                continue
+            try:
+                result = stage_func(item)
+            except Exception as e:
+                self.logger.exception(f'exception in {stage_func.__name__} stage of detection pipeline')
+                self.pipeline_error = e
+                continue
+            if out_q is not None:
+                out_q.put(result)
+        if out_q is not None:
+            out_q.put(None)
+
+    def stop_pipeline(self):
+        """let the frames already in the pipeline finish, then stop the stage threads"""
+        self.stage_qs[0].put(None)
+        for thread in self.pipeline_threads:
+            thread.join(timeout=10)
+            if thread.is_alive():
+                self.logger.warning(f'{thread.name} stage of detection pipeline failed to stop')
+
+    def skip_stale_frames(self, q_item):
+        """if q_item is older than MAX_FRAME_AGE_SECS, discard it along with any other waiting frames except the
+        newest one, so that decisions are always made on the most recent frame available
+        :param q_item: item just taken from the work queue
+        :type q_item: Union[mptools.FrameRef, tuple]
+        :return: the item that should be processed, and the number of frames that were skipped to get to it
+        :rtype: tuple[Union[mptools.FrameRef, tuple], int]
+        """
+        if not self.is_frame(q_item) or self.frame_age(q_item) <= self.MAX_FRAME_AGE_SECS:
+            return q_item, 0
+        n_skipped = 0
+        while True:
+            newer_item = self.work_q.safe_get(timeout=None)
+            if newer_item is None:
+                break
+            if not self.is_frame(newer_item):
+                if newer_item == 'END':
+                    # there won't be anything newer, so move END back to the end of the (now empty) queue
+                    self.work_q.safe_put(newer_item)
+                    break
+                self.mock_hit_flag = True
+                continue
+            if isinstance(q_item, mptools.FrameRef):
+                self.work_q.release(q_item)
+            q_item = newer_item
+            n_skipped += 1
+        self.frames_dropped += n_skipped
+        return q_item, n_skipped
+
+    @staticmethod
+    def is_frame(q_item):
+        return isinstance(q_item, mptools.FrameRef) or (isinstance(q_item, tuple) and not isinstance(q_item[1], str))
+
+    @staticmethod
+    def frame_age(q_item):
+        """time, in seconds, since the frame was captured"""
+        return (gen_utils.current_time_ms() - q_item[0]) / 1000
+
+    def record_latency(self, cap_time):
+        """track the time from frame capture to the hit decision for that frame"""
+        latency = gen_utils.current_time_ms() - cap_time
+        self.latency_timer.update(latency)
+        self.max_latency = max(self.max_latency, latency)
+
+    def update_stage_time(self, stage, secs):
+        prev = self.stage_times.get(stage)
+        self.stage_times[stage] = secs if prev is None else 0.9 * prev + 0.1 * secs
+
+    def report_service_time(self):
+        """publish a moving average of the time it takes to process one frame, which the collector uses to pace itself.
+        When pipelined, the stages overlap and throughput is limited by the slowest one"""
+        stage_times = list(self.stage_times.values())
+        self.service_time = max(stage_times) if self.PIPELINED else sum(stage_times)
+        self.work_q.service_secs.value = self.service_time
+
     def print_info(self):
         if not self.loop_counter % 100:
             self.logger.info(f'{self.loop_counter} detection loops completed. current average detection time is '
                              f'{self.avg_timer.avg * 1000}ms')
+            self.logger.info(f'capture to decision latency: {self.latency_timer.avg:.0f}ms average, '
+                             f'{self.max_latency}ms max. {self.frames_dropped} stale frame(s) dropped')
+            if self.motion_gate:
+                self.logger.info(f'motion gate skipped inference on {self.motion_gate.skip_ratio:.1%} of frames. '
+                                 f'latest motion score {self.motion_gate.score:.4f}')
+            if self.TILE_GRID_SIZE > 1:
+                tile_info = ', '.join(f'{tile}: {timer.avg * 1000:.1f}ms' for tile, timer in
+                                      sorted(self.tile_timers.items()) if timer.avg is not None)
+                self.logger.info(f'average inference time per tile: {tile_info}')
+
+    def prepare_inputs(self, cap_time, frame, detect_frame=None):
+        """
+        run the motion gate, then crop and/or resize the frame to fit the interpreter input (see resize_input).
 
-    def detect(self, img):
-        """run detection on a single image"""
+        once the pipe location is cached, inference is limited to a region of interest around the pipe (if
+        PIPE_ROI_MARGIN is set). If TILE_GRID_SIZE is greater than 1, the region (or the whole frame) is further split
+        into overlapping tiles (see tile_regions), each of which gets its own inference run. Crops are taken from the
+        full resolution frame, so fish keep as much detail as possible
+        :param cap_time: capture time of the frame
+        :type cap_time: int
+        :param frame: full resolution RGB frame
+        :type frame: np.ndarray
+        :param detect_frame: optional copy of the frame that has already been downscaled to fit the interpreter input
+        :type detect_frame: np.ndarray
+        :return: inputs for the inference stage, or None if the motion gate found the scene static and the previous
+            detections should be reused. The inputs are the region of interest (None for the whole frame) and, for each
+            tile scheduled this frame, the tile index, resized image, scale, and offset of the tile within the frame
+        :rtype: tuple[tuple[int, int, int, int], list[tuple[int, np.ndarray, tuple[float, float], tuple[int, int]]]]
+        """
+        self.frames_seen += 1
+        if self.frames_seen % self.DETECT_EVERY_N_FRAMES:
+            # the tracker carries the fish forward until the next frame that gets inference
+            return None
+        if self.motion_gate and not self.motion_gate.check(frame if detect_frame is None else detect_frame):
+            return None
+        height, width = frame.shape[:2]
+        region = None
+        if self.PIPE_ROI_MARGIN is not None and self.pipe_cache and not self.pipe_cache.collecting(cap_time):
+            region = self.pipe_cache.roi(width, height, self.PIPE_ROI_MARGIN)
+        if self.TILE_GRID_SIZE > 1:
+            tiles = tile_regions(region or (0, 0, width, height), self.TILE_GRID_SIZE, self.TILE_OVERLAP)
+            tile_inputs = []
+            for tile in self.schedule_tiles(len(tiles)):
+                xmin, ymin, xmax, ymax = tiles[tile]
+                tile_inputs.append((tile, *self.resize_input(frame[ymin:ymax, xmin:xmax]), (xmin, ymin)))
+            return region, tile_inputs
+        if region is not None:
+            xmin, ymin, xmax, ymax = region
+            return region, [(0, *self.resize_input(frame[ymin:ymax, xmin:xmax]), (xmin, ymin))]
+        if detect_frame is not None:
+            return region, [(0, *self.resize_input(detect_frame, (width, height)), (0, 0))]
+        return region, [(0, *self.resize_input(frame), (0, 0))]
+
+    def schedule_tiles(self, n_tiles):
+        """pick the tiles to run inference on for the current frame. If running every tile would take longer than
+        TILE_BUDGET_SECS (based on the average per-tile inference time so far), only as many tiles as fit within the
+        budget are run, taking turns so that every tile is refreshed every few frames
+        :return: indices of the scheduled tiles
+        :rtype: list[int]
+        """
+        tile_times = [timer.avg for timer in self.tile_timers.values() if timer.avg]
+        if self.TILE_BUDGET_SECS is None or not tile_times:
+            return list(range(n_tiles))
+        n_scheduled = max(1, min(n_tiles, int(self.TILE_BUDGET_SECS // np.mean(tile_times))))
+        scheduled = [(self.next_tile + i) % n_tiles for i in range(n_scheduled)]
+        self.next_tile = (self.next_tile + n_scheduled) % n_tiles
+        return scheduled
+
+    def resize_input(self, frame, full_size=None):
+        """resize a single RGB image, given as a numpy array, to fit inside the interpreter input while keeping its
+        aspect ratio, like pycoral's common.set_resized_input does, but without touching the input tensor. This lets
+        the next frame be resized while the current one is running on the TPU. If the image is a downscaled copy of a
+        larger frame, pass the (width, height) of that frame as full_size so that the boxes map back to its coordinates
+        :return: resized image and the scale to pass to detect.get_objects
+        :rtype: tuple[np.ndarray, tuple[float, float]]
+        """
+        height, width = frame.shape[:2]
+        input_width, input_height = self.input_size
+        ratio = min(input_width / width, input_height / height)
+        size = (int(width * ratio), int(height * ratio))
+        if size == (width, height):
+            # the frame may be a view into shared memory that is released as soon as preprocessing finishes
+            resized = frame.copy()
+        else:
+            resized = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        scale = (size[0] / width, size[1] / height)
+        if full_size:
+            scale = (scale[0] * width / full_size[0], scale[1] * height / full_size[1])
+        return resized, scale
+
+    def invoke(self, resized, scale, offset=(0, 0)):
+        """run the inference backend on a resized image (see resize_input). If the image was cropped from a larger
+        frame, offset is the (x, y) position of the crop within that frame
+        :return: detections, in full frame coordinates (see detections.DET_DTYPE)
+        :rtype: np.ndarray
+        """
         start = time.time()
-        _, scale = common.set_resized_input(
-            self.interpreter, img.size, lambda size: img.resize(size, Image.ANTIALIAS))
-        self.interpreter.invoke()
-        dets = detect.get_objects(self.interpreter, self.defs.CONF_THRESH, scale)
+        try:
+            objs = self.backend.detect(resized, scale, self.defs.CONF_THRESH)
+        except mptools.InferenceUnavailable as e:
+            # a shared inference server can fall behind briefly, so an occasional failure only costs this image its
+            # detections. A server that keeps failing is treated as dead
+            self.inference_failures += 1
+            if self.inference_failures >= self.defs.MAX_TRIES:
+                raise
+            self.logger.warning(f'{e}. treating the image as having no detections')
+            return detections.empty()
+        self.inference_failures = 0
+        dets = detections.from_objects(objs, offset)
         self.avg_timer.update(time.time() - start)
         return dets
 
-    def overlay_boxes(self, buffer_entry: BufferEntry):
-        """open an image, draw detection boxes, and replace the original image"""     
-        draw = ImageDraw.Draw(buffer_entry.img)
-        
-        def overlay_box(det_, color_):
-            bbox = det_.bbox
-            draw.rectangle([(bbox.xmin, bbox.ymin), (bbox.xmax, bbox.ymax)],
-                           outline=color_)
-            draw.text((bbox.xmin + 10, bbox.ymin + 10),
-                      '%s\n%.2f' % (self.labels.get(det_.id, det_.id), det_.score),
-                      fill=color_)
-            
-        fish_dets, pipe_det = self.filter_dets(buffer_entry.dets)
-        intersect_count = 0
-        for det in fish_dets:
-            intersect = detect.BBox.intersect(det.bbox, pipe_det[0].bbox)
-            intersect_flag = (intersect.valid and isclose(intersect.area, det.bbox.area))
-            intersect_count += intersect_flag
-            color = 'green' if intersect_flag else 'red'
-            overlay_box(det, color)
-            
-        color = 'red' if not intersect_count else 'yellow' if intersect_count == 1 else 'green'
-        overlay_box(pipe_det[0], color)
-        
-        img_path = os.path.join(self.img_dir, f'{buffer_entry.cap_time}.jpg')
-        buffer_entry.img.save(img_path)
-        return img_path
-
-    def jpgs_to_mp4(self, img_paths, delete_jpgs=True):
-        """convert a series of jpgs to a single mp4, and (if delete_jpgs) delete the original images"""
-        dest_dir = self.defs.PROJ_VID_DIR
-        vid_path = internet_of_fish.modules.advanced_utils.jpgs_to_mp4(img_paths, dest_dir, 1//self.defs.INTERVAL_SECS)
-        if delete_jpgs:
-            [os.remove(x) for x in img_paths]
-        return vid_path
+    def detect(self, frame, full_size=None):
+        """run detection on a single RGB image, given as a numpy array. See resize_input for full_size"""
+        return self.invoke(*self.resize_input(frame, full_size))
+
+    def make_source_writer(self):
+        """open the video that annotated frames from the source video are appended to (see AnnotatedVideoWriter)"""
+        base_name = os.path.splitext(os.path.basename(self.metadata['source']))[0]
+        vid_path = os.path.join(self.defs.PROJ_VID_DIR, f'{base_name}_annotated.mp4')
+        index_path = os.path.join(self.defs.PROJ_VID_DIR, f'{base_name}_annotated.csv')
+        return clip_writer.AnnotatedVideoWriter(vid_path, 1 / self.defs.INTERVAL_SECS,
+                                                index_path if self.defs.SOURCE_FRAME_INDEX else None)
 
     def check_for_hit(self, fish_dets, pipe_det):
         """check for multiple fish intersecting with the pipe and adjust hit counter accordingly"""
         if (len(fish_dets) < 2) or (len(pipe_det) != 1):
             return False
-        intersect_count = 0
-        pipe_det = pipe_det[0]
-        for det in fish_dets:
-            intersect = detect.BBox.intersect(det.bbox, pipe_det.bbox)
-            intersect_count += (intersect.valid and isclose(intersect.area, det.bbox.area))
-        if intersect_count < 2:
-            return False
-        else:
-            return True
+        fish_inside = detections.inside(detections.boxes(fish_dets), detections.boxes(pipe_det)[0])
+        return np.count_nonzero(fish_inside) >= 2
 
     def filter_dets(self, dets):
         """keep only the the highest confidence pipe detection, and the top n highest confidence fish detections"""
-        fish_dets = [d for d in dets if d.id == self.ids['fish']][:self.max_fish]
-        pipe_det = [d for d in dets if d.id == self.ids['pipe']][:1]
+        fish_dets = detections.select(dets, self.ids['fish'], self.max_fish)
+        pipe_det = detections.select(dets, self.ids['pipe'], 1)
         return fish_dets, pipe_det
 
     def shutdown(self):
+        if self.PIPELINED and self.pipeline_threads:
+            self.stop_pipeline()
         if self.avg_timer.avg:
             self.logger.log(logging.INFO, f'average time for detection loop: {self.avg_timer.avg * 1000}ms')
-        if self.metadata['source']:
-            self.jpgs_to_mp4(glob(os.path.join(self.img_dir, '*.jpg')))
+        if self.source_writer:
+            self.source_writer.close()
+        if self.detection_log:
+            self.detection_log.close()
         if self.metadata['demo'] or self.metadata['source']:
             self.event_q.safe_put(
                 mptools.EventMessage(self.name, 'ENTER_PASSIVE_MODE', f'detection complete, entering passive mode'))
+        self.clip_q.safe_put('END')
         self.work_q.close()
         self.event_q.close()
 
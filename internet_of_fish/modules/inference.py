@@ -0,0 +1,288 @@
+import os
+import re
+from collections import namedtuple
+from glob import glob
+
+# the tflite runtime is imported by the backends that need it, and pycoral only by the Edge TPU backend, so that the
+# CPU and fake backends (and the rest of this module) can be used on machines without them
+
+BACKENDS = ['auto', 'edgetpu', 'cpu', 'fake']
+
+# a single detection, with the same fields as pycoral's detect.Object. bbox is (xmin, ymin, xmax, ymax)
+Object = namedtuple('Object', ['id', 'score', 'bbox'])
+
+
+def import_tflite():
+    """the tflite interpreter module, from tflite_runtime if it is installed, or from a full tensorflow install (e.g.,
+    on a workstation) otherwise"""
+    try:
+        import tflite_runtime.interpreter as tflite
+    except ImportError:
+        from tensorflow import lite as tflite
+    return tflite
+
+
+def read_labels(label_path):
+    """
+    read a label file in the same formats as pycoral.utils.dataset.read_label_file: either one label per line, or
+    lines of the form "<id> <label>" (or "<id>: <label>")
+    :return: labels, by class id
+    :rtype: dict[int, str]
+    """
+    labels = {}
+    with open(label_path, 'r', encoding='utf-8') as f:
+        for row_number, line in enumerate(f.readlines()):
+            pair = re.split(r'[:\s]+', line.strip(), maxsplit=1)
+            if len(pair) == 2 and pair[0].strip().isdigit():
+                labels[int(pair[0])] = pair[1].strip()
+            else:
+                labels[row_number] = line.strip()
+    return labels
+
+
+def decode_ssd(boxes, class_ids, scores, count, input_size, scale, conf_thresh):
+    """
+    turn the outputs of an SSD postprocess op into detections, the same way pycoral.adapters.detect.get_objects does
+    :param boxes: (ymin, xmin, ymax, xmax) of each detection, as fractions of the input size
+    :type boxes: np.ndarray
+    :param class_ids: class id of each detection
+    :type class_ids: np.ndarray
+    :param scores: score of each detection
+    :type scores: np.ndarray
+    :param count: number of valid detections
+    :type count: int
+    :param input_size: (width, height) of the model input
+    :type input_size: tuple[int, int]
+    :param scale: scale factors between the image the boxes should map onto and the model input (see
+        InferenceBackend.detect)
+    :type scale: tuple[float, float]
+    :param conf_thresh: minimum score of the returned detections
+    :type conf_thresh: float
+    :rtype: list[Object]
+    """
+    sx, sy = input_size[0] / scale[0], input_size[1] / scale[1]
+    objs = []
+    for i in range(count):
+        if scores[i] >= conf_thresh:
+            ymin, xmin, ymax, xmax = boxes[i]
+            objs.append(Object(int(class_ids[i]), float(scores[i]),
+                               (int(xmin * sx), int(ymin * sy), int(xmax * sx), int(ymax * sy))))
+    return objs
+
+
+def locate_labels(models_dir, model_id):
+    """path to the .txt label file for a given model_id"""
+    label_paths = glob(os.path.join(models_dir, model_id, '*.txt'))
+    if not label_paths:
+        raise FileNotFoundError(f'no .txt label file found in {os.path.join(models_dir, model_id)}')
+    return label_paths[0]
+
+
+def locate_model(models_dir, model_id, edgetpu=True):
+    """
+    find the model and label files for a given model_id. Models compiled for the Edge TPU are expected to follow the
+    edgetpu_compiler naming convention (ending in _edgetpu.tflite). If there is no model of the requested type, any
+    .tflite file in the model directory is used instead
+    :param edgetpu: if True, look for a model compiled for the Edge TPU. Otherwise, look for a plain tflite model
+    :type edgetpu: bool
+    :return: path to the .tflite model file and path to the .txt label file
+    :rtype: tuple[str, str]
+    """
+    model_dir = os.path.join(models_dir, model_id)
+    all_models = sorted(glob(os.path.join(model_dir, '*.tflite')))
+    edgetpu_models = [m for m in all_models if m.endswith('_edgetpu.tflite')]
+    cpu_models = [m for m in all_models if m not in edgetpu_models]
+    models = (edgetpu_models if edgetpu else cpu_models) or all_models
+    if not models:
+        raise FileNotFoundError(f'no .tflite model found in {model_dir}')
+    return models[0], locate_labels(models_dir, model_id)
+
+
+def read_input_size(model_path):
+    """read the (width, height) of a model's input tensor without loading the model onto the Edge TPU. This lets other
+    processes size their images for the detector while the TPU is owned by the DetectorWorker"""
+    interpreter = import_tflite().Interpreter(model_path=model_path)
+    _, height, width, _ = interpreter.get_input_details()[0]['shape']
+    return int(width), int(height)
+
+
+def model_input_size(models_dir, model_id, backend='auto'):
+    """
+    the (width, height) of the input of the model that make_backend would run, without loading it onto the Edge TPU
+    (see read_input_size)
+    :return: the input size, or None if it could not be determined, e.g., because there is no model file (as is
+        allowed for the fake backend) or no tflite runtime on this machine
+    :rtype: tuple[int, int]
+    """
+    if backend == 'fake':
+        return FakeBackend().input_size
+    try:
+        model_path, _ = locate_model(models_dir, model_id)
+        return read_input_size(model_path)
+    except (FileNotFoundError, ImportError):
+        return None
+
+
+def edgetpu_available():
+    """check whether an Edge TPU, and the runtime needed to use it, are present on this machine"""
+    try:
+        from pycoral.utils.edgetpu import list_edge_tpus
+    except (ImportError, OSError):
+        return False
+    return bool(list_edge_tpus())
+
+
+def make_backend(models_dir, model_id, backend='auto', num_threads=None):
+    """
+    create the inference backend for a model. With backend='auto', the Edge TPU is used if one is present and the
+    model directory holds a model compiled for it. Otherwise, the model runs on the CPU
+    :param backend: one of BACKENDS
+    :type backend: str
+    :param num_threads: number of threads for the CPU backend. Defaults to the number of CPUs
+    :type num_threads: int
+    :return: the backend, and the path to the label file for the model
+    :rtype: tuple[InferenceBackend, str]
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'unknown inference backend {backend}. Options are {BACKENDS}')
+    if backend == 'fake':
+        # no model file is needed, only the labels
+        return FakeBackend(), locate_labels(models_dir, model_id)
+    if backend == 'auto':
+        backend = 'edgetpu' if edgetpu_available() else 'cpu'
+    model_path, label_path = locate_model(models_dir, model_id, edgetpu=(backend == 'edgetpu'))
+    if backend == 'edgetpu':
+        return EdgeTPUBackend(model_path), label_path
+    if model_path.endswith('_edgetpu.tflite'):
+        raise FileNotFoundError(f'only found a model compiled for the Edge TPU ({model_path}), but no Edge TPU is '
+                                f'available. Add a plain tflite version of the model to run it on the CPU')
+    return CPUBackend(model_path, num_threads), label_path
+
+
+class InferenceBackend:
+
+    """common interface to the detection models. Subclasses set self.input_size and implement detect"""
+
+    name = None
+
+    def __init__(self):
+        self.input_size = None
+
+    def detect(self, resized, scale, conf_thresh):
+        """
+        run the model on a single image
+        :param resized: RGB image that fits within self.input_size, and is placed in its top left corner
+        :type resized: np.ndarray
+        :param scale: scale factors between the image the boxes should map onto and resized (see
+            pycoral.adapters.detect.get_objects)
+        :type scale: tuple[float, float]
+        :param conf_thresh: minimum score of the returned detections
+        :type conf_thresh: float
+        :return: detections, in descending order of score
+        :rtype: list[Object]
+        """
+        raise NotImplementedError
+
+    def __str__(self):
+        return f'{self.name} backend'
+
+
+class TFLiteBackend(InferenceBackend):
+
+    """runs a tflite SSD detection model. Subclasses set up self.interpreter"""
+
+    def __init__(self, model_path):
+        super().__init__()
+        self.model_path = model_path
+        self.interpreter = self.make_interpreter()
+        self.interpreter.allocate_tensors()
+        input_details = self.interpreter.get_input_details()[0]
+        _, height, width, _ = input_details['shape']
+        self.input_size = (int(width), int(height))
+        self.input_index = input_details['index']
+        self.output_indices = self.find_outputs()
+
+    def make_interpreter(self):
+        raise NotImplementedError
+
+    def find_outputs(self):
+        """
+        tensor indices of the boxes, class ids, scores and count output by the SSD postprocess op. Follows the same
+        rules as pycoral.adapters.detect.get_objects: use the output names from the model signature if it has one,
+        and otherwise go by the order of the outputs, which differs between models exported from TF1 and TF2
+        :rtype: tuple[int, int, int, int]
+        """
+        get_signatures = getattr(self.interpreter, '_get_full_signature_list', None)
+        signatures = get_signatures() if get_signatures else None
+        if signatures:
+            outputs = signatures[next(iter(signatures))]['outputs']
+            return outputs['output_3'], outputs['output_2'], outputs['output_1'], outputs['output_0']
+        output_details = self.interpreter.get_output_details()
+        indices = [details['index'] for details in output_details]
+        if output_details[3]['shape'].prod() == 1:
+            return indices[0], indices[1], indices[2], indices[3]
+        return indices[1], indices[3], indices[0], indices[2]
+
+    def set_input(self, resized):
+        # the tensor view must not outlive this method, as the interpreter refuses to run while any view into its
+        # buffers exists
+        height, width = resized.shape[:2]
+        tensor = self.interpreter.tensor(self.input_index)()[0]
+        tensor.fill(0)
+        tensor[:height, :width] = resized
+
+    def detect(self, resized, scale, conf_thresh):
+        self.set_input(resized)
+        self.interpreter.invoke()
+        boxes, class_ids, scores, count = (self.interpreter.tensor(index)()[0] for index in self.output_indices)
+        return decode_ssd(boxes, class_ids, scores, int(count), self.input_size, scale, conf_thresh)
+
+    def __str__(self):
+        return f'{self.name} backend running {os.path.basename(self.model_path)}'
+
+
+class EdgeTPUBackend(TFLiteBackend):
+
+    name = 'edgetpu'
+
+    def make_interpreter(self):
+        from pycoral.utils.edgetpu import make_interpreter
+        return make_interpreter(self.model_path)
+
+
+class CPUBackend(TFLiteBackend):
+
+    name = 'cpu'
+
+    def __init__(self, model_path, num_threads=None):
+        self.num_threads = num_threads or os.cpu_count()
+        super().__init__(model_path)
+
+    def make_interpreter(self):
+        return import_tflite().Interpreter(model_path=self.model_path, num_threads=self.num_threads)
+
+    def __str__(self):
+        return f'{super().__str__()} on {self.num_threads} thread(s)'
+
+
+class FakeBackend(InferenceBackend):
+
+    name = 'fake'
+
+    def __init__(self, dets=None, input_size=(320, 320)):
+        """
+        deterministic stand-in for a real model, for tests and for exercising the rest of the pipeline without one
+        :param dets: detections returned for every image, given in the coordinates of the image the boxes map onto.
+            Defaults to no detections
+        :type dets: list[Object]
+        :param input_size: (width, height) of the pretend input tensor
+        :type input_size: tuple[int, int]
+        """
+        super().__init__()
+        self.dets = dets or []
+        self.input_size = input_size
+        self.call_count = 0
+
+    def detect(self, resized, scale, conf_thresh):
+        self.call_count += 1
+        return sorted([det for det in self.dets if det.score >= conf_thresh], key=lambda det: -det.score)
@@ -10,6 +10,7 @@ from internet_of_fish.modules.utils.gen_utils import finput
 
 my_regexes = SimpleNamespace()
 my_regexes.any_int = r'\d+'
+my_regexes.any_positive_int = r'0*[1-9]\d*'
 my_regexes.any_float = r'[0-9]*\.?[0-9]+'
 my_regexes.any_float_less_than_1 = r'0*?\.[0-9]+'
 my_regexes.any_int_less_than_24 = r'([01]?[0-9]|2[0-3])'
@@ -207,16 +208,170 @@ class AdvancedConfigDict(MetaDataDictBase):
                           value='0.5',
                           pattern=my_regexes.any_float,
                           help_str='time between image captures in seconds'),
+            'TARGET_Q_OCCUPANCY':
+                MetaValue(key='TARGET_Q_OCCUPANCY',
+                          value='0.2',
+                          pattern=my_regexes.any_float_less_than_1,
+                          help_str='fraction of the image queue that the collector tries to keep filled. The collection '
+                                   'interval is lengthened when the queue fills past this point, and shortened again '
+                                   '(down to INTERVAL_SECS) when the detector catches up'),
+            'CAPTURE_FORMAT':
+                MetaValue(key='CAPTURE_FORMAT',
+                          value='rgb',
+                          options=['rgb', 'yuv', 'jpeg'],
+                          help_str='format used when capturing images for the detector. "rgb" and "yuv" grab raw '
+                                   'frames from the video port into a reusable array, while "jpeg" encodes each frame '
+                                   'and then decodes it again on the cpu'),
+            'CAPTURE_MODE':
+                MetaValue(key='CAPTURE_MODE',
+                          value='stream',
+                          options=['stream', 'timer'],
+                          help_str='"stream" collects frames in a dedicated thread from a persistent continuous '
+                                   'capture, timestamped by the camera clock. "timer" sets up a new capture each '
+                                   'interval'),
+            'DETECT_STREAM':
+                MetaValue(key='DETECT_STREAM',
+                          value='True',
+                          pattern=my_regexes.any_bool,
+                          help_str='If True, the camera hardware produces a second, low resolution stream sized to '
+                                   'the model input, which is used for detection instead of resizing each full '
+                                   'resolution frame on the cpu'),
             'HIT_THRESH_SECS':
                 MetaValue(key='HIT_THRESH_SECS',
                           value='5',
                           pattern=my_regexes.any_int,
                           help_str='approximate number of seconds of activity before an event should be registered'),
-            'IMG_BUFFER_SECS':
-                MetaValue(key='IMG_BUFFER_SECS',
-                          value='30',
+            'HIT_MODE':
+                MetaValue(key='HIT_MODE',
+                          value='tracker',
+                          options=['tracker', 'counter'],
+                          help_str='how the detector decides that a spawning event may be happening. "tracker" follows '
+                                   'individual fish from frame to frame, and registers a hit when two fish have each '
+                                   'been in the pipe for HIT_THRESH_SECS. "counter" counts frames with two or more '
+                                   'fish in the pipe, minus frames without'),
+            'DETECT_EVERY_N_FRAMES':
+                MetaValue(key='DETECT_EVERY_N_FRAMES',
+                          value='1',
+                          pattern=my_regexes.any_int,
+                          help_str='run inference on only every nth frame, letting the tracker fill in the frames in '
+                                   'between. Only used when HIT_MODE is "tracker"'),
+            'MOTION_THRESH':
+                MetaValue(key='MOTION_THRESH',
+                          value='0.002',
+                          pattern=my_regexes.any_float_less_than_1,
+                          help_str='fraction of (downsampled) pixels that must change before the detector runs '
+                                   'inference on a frame. For frames below this threshold, the previous detections are '
+                                   'reused. Set to None to run inference on every frame'),
+            'MOTION_MAX_SKIP_RATIO':
+                MetaValue(key='MOTION_MAX_SKIP_RATIO',
+                          value='0.9',
+                          pattern=my_regexes.any_float_less_than_1,
+                          help_str='max fraction of frames on which inference can be skipped due to lack of motion'),
+            'DETECT_PIPELINE':
+                MetaValue(key='DETECT_PIPELINE',
+                          value='True',
+                          pattern=my_regexes.any_bool,
+                          help_str='If True, the detector resizes, runs inference on, and postprocesses consecutive '
+                                   'frames in parallel threads, so that the CPU and TPU work at the same time'),
+            'SOURCE_FRAME_INDEX':
+                MetaValue(key='SOURCE_FRAME_INDEX',
+                          value='True',
+                          pattern=my_regexes.any_bool,
+                          help_str='If True, analyzing a source video also writes a csv alongside the annotated '
+                                   'video that maps each of its frames to a frame number in the source video'),
+            'INFERENCE_BACKEND':
+                MetaValue(key='INFERENCE_BACKEND',
+                          value='auto',
+                          options=['auto', 'edgetpu', 'cpu', 'fake'],
+                          help_str='where the detector runs its model. "auto" uses the Edge TPU if one is connected '
+                                   'and the model directory has a model compiled for it (*_edgetpu.tflite), and the '
+                                   'CPU otherwise. "fake" returns no detections, and is only useful for testing'),
+            'INFERENCE_SERVER':
+                MetaValue(key='INFERENCE_SERVER',
+                          value='False',
+                          pattern=my_regexes.any_bool,
+                          help_str='If True, the model is loaded once by a dedicated inference server process that '
+                                   'all detectors on this machine share. Otherwise, each detector loads its own. '
+                                   'Only worth enabling if several detectors run at once, since every inference '
+                                   'then takes an extra trip through the request and response queues'),
+            'CPU_THREADS':
+                MetaValue(key='CPU_THREADS',
+                          value='None',
                           pattern=my_regexes.any_int,
-                          help_str='length of video, in seconds, that will be saved when a hit occurs'),
+                          help_str='number of threads used by the cpu inference backend. Set to None to use one '
+                                   'thread per cpu'),
+            'DETECTION_LOG':
+                MetaValue(key='DETECTION_LOG',
+                          value='True',
+                          pattern=my_regexes.any_bool,
+                          help_str='If True, the detections for every processed frame are appended to a binary log in '
+                                   'the Detections folder of the project, which is uploaded along with the videos'),
+            'DETECTION_LOG_CHUNK_RECORDS':
+                MetaValue(key='DETECTION_LOG_CHUNK_RECORDS',
+                          value='1000000',
+                          pattern=my_regexes.any_int,
+                          help_str='maximum number of detections stored in each file of the detection log. Each '
+                                   'detection takes 32 bytes'),
+            'PIPE_CACHE':
+                MetaValue(key='PIPE_CACHE',
+                          value='True',
+                          pattern=my_regexes.any_bool,
+                          help_str='If True, the detector learns a stable location for the pipe and uses it in place '
+                                   'of the per-frame pipe detections'),
+            'PIPE_CACHE_WARMUP_FRAMES':
+                MetaValue(key='PIPE_CACHE_WARMUP_FRAMES',
+                          value='20',
+                          pattern=my_regexes.any_int,
+                          help_str='number of frames used to learn (and re-learn) the pipe location'),
+            'PIPE_CACHE_REVALIDATE_SECS':
+                MetaValue(key='PIPE_CACHE_REVALIDATE_SECS',
+                          value='900',
+                          pattern=my_regexes.any_int,
+                          help_str='seconds between checks that the cached pipe location is still correct'),
+            'PIPE_ROI_MARGIN':
+                MetaValue(key='PIPE_ROI_MARGIN',
+                          value='0.5',
+                          pattern=my_regexes.any_float,
+                          help_str='once the pipe location is cached, inference is limited to the area around the '
+                                   'pipe, padded on each side by this fraction of the pipe size. Set to None to always '
+                                   'run inference on the full frame'),
+            'TILE_GRID_SIZE':
+                MetaValue(key='TILE_GRID_SIZE',
+                          value='1',
+                          pattern=my_regexes.any_positive_int,
+                          help_str='if greater than 1, the detector splits each frame (or the area around the pipe) '
+                                   'into a grid of this many tiles per side, and runs inference on each tile '
+                                   'separately. Slower, but better at finding small fish'),
+            'TILE_OVERLAP':
+                MetaValue(key='TILE_OVERLAP',
+                          value='0.2',
+                          pattern=my_regexes.any_float_less_than_1,
+                          help_str='fraction of each tile that overlaps with its neighbors'),
+            'TILE_BUDGET_SECS':
+                MetaValue(key='TILE_BUDGET_SECS',
+                          value='0.25',
+                          pattern=my_regexes.any_float,
+                          help_str='max time, in seconds, to spend on tiled inference per frame. Tiles that do not fit '
+                                   'are run on later frames. Set to None to run every tile on every frame'),
+            'LATEST_FRAME_WINS':
+                MetaValue(key='LATEST_FRAME_WINS',
+                          value='True',
+                          pattern=my_regexes.any_bool,
+                          help_str='If True, the detector skips ahead to the newest queued frame whenever it falls '
+                                   'more than MAX_FRAME_AGE_SECS behind, rather than working through the backlog. '
+                                   'Ignored when analyzing a source video'),
+            'MAX_FRAME_AGE_SECS':
+                MetaValue(key='MAX_FRAME_AGE_SECS',
+                          value='2',
+                          pattern=my_regexes.any_float,
+                          help_str='age, in seconds, after which a queued frame is considered stale'),
+            'IMG_BUFFER_BYTES':
+                MetaValue(key='IMG_BUFFER_BYTES',
+                          value='50000000',
+                          pattern=my_regexes.any_int,
+                          help_str='memory, in bytes, set aside for the compressed frames that are saved as a video '
+                                   'when a hit occurs. At the default jpeg quality a full resolution frame takes '
+                                   'roughly 100-200KB'),
             'START_HOUR':
                 MetaValue(key='START_HOUR',
                           value='8',
@@ -227,6 +382,19 @@ class AdvancedConfigDict(MetaDataDictBase):
                           value='18',
                           pattern=my_regexes.any_int_less_than_24,
                           help_str='daily collection end time. e.g., set to 19 to end at 7pm'),
+            'EVENT_CLIP_PRE_SECS':
+                MetaValue(key='EVENT_CLIP_PRE_SECS',
+                          value='20',
+                          pattern=my_regexes.any_int,
+                          help_str='seconds of full framerate video, from before a possible spawning event, that '
+                                   'the collector keeps in memory and saves when the event occurs. Set to 0 to '
+                                   'disable, in which case the notification uses the detector frames instead'),
+            'EVENT_CLIP_POST_SECS':
+                MetaValue(key='EVENT_CLIP_POST_SECS',
+                          value='10',
+                          pattern=my_regexes.any_int,
+                          help_str='seconds of full framerate video, from after a possible spawning event, that '
+                                   'are added to the event clip'),
             'SPLIT_AM_PM':
                 MetaValue(key='SPLIT_AM_PM',
                           value='True',
@@ -279,6 +447,12 @@ class AdvancedConfigDict(MetaDataDictBase):
                           pattern=my_regexes.any_float,
                           help_str='default time to wait for a process to shut down normally before '
                                    'force-terminating it'),
+            'TERMINATE_WAIT_SECS':
+                MetaValue(key='TERMINATE_WAIT_SECS',
+                          value='1',
+                          pattern=my_regexes.any_float,
+                          help_str='time to wait for a process to exit after sending it SIGTERM, before sending it '
+                                   'SIGKILL'),
             # 'STATUS_INTERVAL':
             #     MetaValue(key='STATUS_INTERVAL',
             #               value='60',
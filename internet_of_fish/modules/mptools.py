@@ -1,30 +1,249 @@
+import bisect
+import ctypes
 import functools
 import logging
 import multiprocessing as mp
+import multiprocessing.connection
 import multiprocessing.queues as mpq
+import multiprocessing.util
 import signal
 import time
+from collections import namedtuple, deque
 from queue import Empty, Full
+
+import numpy as np
 from internet_of_fish.modules.utils import gen_utils
 import re
 
 """adapted from https://github.com/PamelaM/mptools"""
 
 
+# -- Instrumentation support
+
+class SharedStats:
+
+    # bin edges, in seconds, for timing histograms. Runs from 0.1ms to about 100s, doubling each bin
+    TIME_BINS = [1e-4 * 2 ** i for i in range(21)]
+    # bin edges for histograms of queue occupancy, as a fraction of maxsize
+    OCCUPANCY_BINS = [i / 10 for i in range(1, 11)]
+
+    def __init__(self, counters, histograms=None):
+        """
+        counters and histograms kept in a block of shared memory, so that any process can read them (see snapshot)
+        while the owning process keeps updating them, without messaging it. Updates are not locked, which keeps them
+        cheap. The catch is that a counter updated by several processes at once (e.g., the puts to a queue with
+        several producers) can occasionally miss an increment
+        :param counters: names of the counters
+        :type counters: list[str]
+        :param histograms: bin edges of each histogram, by name. Each histogram has one bin for values below the first
+                           edge, plus one bin per edge for values greater than or equal to that edge
+        :type histograms: dict[str, list[float]]
+        """
+        self.counters = {name: i for i, name in enumerate(counters)}
+        self.histograms = {}
+        size = len(counters)
+        for name, edges in (histograms or {}).items():
+            self.histograms[name] = (size, list(edges))
+            size += len(edges) + 1
+        self._shm = mp.RawArray(ctypes.c_double, size)
+        self.created = time.time()
+
+    def incr(self, name, n=1):
+        self._shm[self.counters[name]] += n
+
+    def set(self, name, val):
+        self._shm[self.counters[name]] = val
+
+    def record(self, name, val):
+        """add a value to a histogram"""
+        offset, edges = self.histograms[name]
+        self._shm[offset + bisect.bisect_right(edges, val)] += 1
+
+    def snapshot(self):
+        """
+        :return: the current value of each counter, plus {'edges': bin edges, 'counts': count in each bin} for each
+                 histogram, and the number of seconds since the stats were created (as uptime_secs)
+        :rtype: dict
+        """
+        values = self._shm[:]
+        snapshot = {name: values[i] for name, i in self.counters.items()}
+        for name, (offset, edges) in self.histograms.items():
+            counts = values[offset:offset + len(edges) + 1]
+            snapshot[name] = {'edges': edges, 'counts': [int(count) for count in counts]}
+        snapshot['uptime_secs'] = time.time() - self.created
+        return snapshot
+
+    @staticmethod
+    def quantile(histogram, q):
+        """
+        approximate quantile of a histogram from a snapshot
+        :param histogram: {'edges': ..., 'counts': ...}, as returned by snapshot
+        :type histogram: dict
+        :param q: quantile to find, between 0 and 1
+        :type q: float
+        :return: upper edge of the bin the quantile falls into (inf for the last bin), or None if the histogram is empty
+        :rtype: float
+        """
+        edges, counts = histogram['edges'], histogram['counts']
+        total = sum(counts)
+        if not total:
+            return None
+        cumulative = 0
+        for i, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= q * total:
+                return edges[i] if i < len(edges) else float('inf')
+
+
 # -- Queue handling support
 
+class OverflowPolicy:
+
+    POLICIES = ['block', 'drop_newest', 'drop_oldest', 'every_nth']
+
+    def __init__(self, policy='drop_newest', every_n=2):
+        """
+        what a queue does with a new item when it is full, plus counters (shared between processes) of what happened
+        to the items that didn't fit.
+
+        'block': wait up to the put timeout for space, then drop the new item
+        'drop_newest': drop the new item right away
+        'drop_oldest': evict the item at the head of the queue to make room for the new one
+        'every_nth': while the queue is full, evict the head to make room for every nth new item, and drop the rest.
+            This thins out the items in the queue evenly, instead of leaving a gap
+
+        :param policy: one of OverflowPolicy.POLICIES
+        :type policy: str
+        :param every_n: the n used by the 'every_nth' policy
+        :type every_n: int
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f'unknown overflow policy {policy}. Options are {self.POLICIES}')
+        self.policy = policy
+        self.every_n = max(1, int(every_n))
+        self.overflows = mp.Value(ctypes.c_long, 0)
+        self.dropped = mp.Value(ctypes.c_long, 0)
+        self.evicted = mp.Value(ctypes.c_long, 0)
+
+    @staticmethod
+    def count(counter, n=1):
+        with counter.get_lock():
+            counter.value += n
+            return counter.value
+
+    def should_evict(self):
+        """count an overflow, and decide how to handle it
+        :return: True if the head of the queue should be evicted to make room for the new item, False if the new item
+            should be dropped
+        :rtype: bool
+        """
+        n_overflows = self.count(self.overflows)
+        if self.policy == 'drop_oldest':
+            return True
+        return self.policy == 'every_nth' and not n_overflows % self.every_n
+
+    def stats(self):
+        return {'policy': self.policy, 'dropped': self.dropped.value, 'evicted': self.evicted.value}
+
+    def __str__(self):
+        return f'{self.policy} policy: {self.dropped.value} item(s) dropped, {self.evicted.value} evicted'
+
+
+class ItemBatch(list):
+    """several queue items sent as a single message (see MPQueue.put_many)"""
+
+
 class MPQueue(mpq.Queue):
 
-    def __init__(self, *args, **kwargs):
+    # attributes shared between the processes using the queue, in addition to those of the base class
+    _SHARED_ATTRS = ['service_secs', 'producer_interval', 'overflow', 'stats', 'name']
+
+    def __init__(self, *args, policy='drop_newest', every_n=2, name=None, **kwargs):
         """
-        flexible queue object built on the multiprocessing.queues.Queue class.
+        flexible queue object built on the multiprocessing.queues.Queue class. Keeps counts of the items put and
+        taken, and histograms of its occupancy and of the time items spend waiting in it (see snapshot).
         :param args: positional arguments passed to the parent class __init__
+        :param policy: how safe_put handles a full queue (see OverflowPolicy)
+        :type policy: str
+        :param every_n: see OverflowPolicy
+        :type every_n: int
+        :param name: name used to identify the queue in stats snapshots
+        :type name: str
         :param kwargs: keyword args passed to the parent class __init__
         """
         ctx = mp.get_context()
         if 'maxsize' not in kwargs:
             kwargs.update({'maxsize': 100})
         super().__init__(*args, **kwargs, ctx=ctx)
+        # feedback shared between producer and consumer processes. service_secs is the consumer's recent average time
+        # to process one item, and producer_interval is the interval at which the producer is currently adding items
+        self.service_secs = ctx.RawValue(ctypes.c_double, 0.0)
+        self.producer_interval = ctx.RawValue(ctypes.c_double, 0.0)
+        self.overflow = OverflowPolicy(policy, every_n)
+        self.stats = SharedStats(['put', 'got'], {'wait_secs': SharedStats.TIME_BINS,
+                                                  'occupancy': SharedStats.OCCUPANCY_BINS})
+        self.name = name
+        self._reset_pending()
+        mp.util.register_after_fork(self, MPQueue._reset_pending)
+
+    def __getstate__(self):
+        return super().__getstate__() + (tuple(getattr(self, attr) for attr in self._SHARED_ATTRS),)
+
+    def __setstate__(self, state):
+        super().__setstate__(state[:-1])
+        for attr, val in zip(self._SHARED_ATTRS, state[-1]):
+            setattr(self, attr, val)
+        self._reset_pending()
+
+    def _reset_pending(self):
+        # items from batches that this process has received but not yet returned. Never shared between processes
+        self._pending = deque()
+
+    def _unpack(self, item):
+        """return the first item of a batch, and hold on to the rest for the following gets"""
+        if isinstance(item, ItemBatch):
+            self._pending.extend(item[1:])
+            return item[0]
+        return item
+
+    def put(self, obj, block=True, timeout=None):
+        # every item travels with the time it was put, so that the consumer can measure how long it waited
+        super().put((time.time(), obj), block, timeout)
+        self.stats.incr('put', len(obj) if isinstance(obj, ItemBatch) else 1)
+        try:
+            self.stats.record('occupancy', self.occupancy())
+        except NotImplementedError:
+            # qsize isn't available on some platforms (e.g., macOS)
+            pass
+
+    def get(self, block=True, timeout=None):
+        put_time, obj = super().get(block, timeout)
+        self.stats.incr('got', len(obj) if isinstance(obj, ItemBatch) else 1)
+        self.stats.record('wait_secs', time.time() - put_time)
+        return obj
+
+    def occupancy(self):
+        """
+        :return: number of items currently in the queue, as a fraction of maxsize
+        :rtype: float
+        """
+        return self.qsize() / self._maxsize
+
+    def snapshot(self):
+        """
+        current stats of the queue (see SharedStats.snapshot), plus its depth, overflow counts, and the latest
+        service_secs and producer_interval published by its consumer and producer. Can be called from any process
+        :rtype: dict
+        """
+        snapshot = self.stats.snapshot()
+        snapshot.update(self.overflow.stats())
+        snapshot['service_secs'] = self.service_secs.value
+        snapshot['producer_interval'] = self.producer_interval.value
+        try:
+            snapshot['depth'] = self.qsize()
+        except NotImplementedError:
+            snapshot['depth'] = None
+        return snapshot
 
     def safe_get(self, timeout=0.02):
         """
@@ -39,47 +258,165 @@ class MPQueue(mpq.Queue):
         """
         if self._closed:
             return
+        if self._pending:
+            return self._pending.popleft()
         try:
             if timeout is None:
                 # get an item from the queue immediately, raise an Empty exception if the queue is currently empty
-                return self.get(block=False)
+                return self._unpack(self.get(block=False))
             else:
                 # get an item from the queue, waiting up to "timeout" seconds for the queue to be nonempty. Raise an
                 # Empty exception after the timeout expires
-                return self.get(block=True, timeout=timeout)
+                return self._unpack(self.get(block=True, timeout=timeout))
         except Empty:
             # catch the Empty exception that might be raised by either of the above self.get calls, and return None
             return None
 
+    def wait(self, timeout=None, wakeup=None):
+        """
+        block until there is an item to take from the queue, without taking it. Unlike a polling loop around safe_get,
+        the process sleeps until it is woken by new data (or by the wakeup event)
+        :param timeout: max number of seconds to wait. If None, wait indefinitely
+        :type timeout: float
+        :param wakeup: if given, also stop waiting as soon as this event is set
+        :type wakeup: ShutdownEvent
+        :return: True if there is an item ready, though another consumer of the queue may still take it first
+        :rtype: bool
+        """
+        if self._closed:
+            return False
+        if self._pending:
+            return True
+        waitables = [self._reader] if wakeup is None else [self._reader, wakeup]
+        return self._reader in mp.connection.wait(waitables, timeout)
+
+    def wait_get(self, timeout=None, wakeup=None):
+        """
+        blocking counterpart to safe_get. Waits (see wait) until an item arrives, the wakeup event is set, or the
+        timeout expires
+        :return: the next item in the queue, or None if there wasn't one
+        """
+        if self.wait(timeout, wakeup):
+            return self.safe_get(timeout=None)
+        return None
+
     def safe_put(self, item, timeout=0.02):
         """
         similar to the .put() base class, but more robust. In situations where .put() would raise the Full exception,
-        this method catches the exception and instead returns False. Also obscures the .put() block keyword argument
-        to prevent the safe_put command from blocking indefinitely.
+        this method handles the overflow according to the queue's policy (see OverflowPolicy) instead. Also obscures
+        the .put() block keyword argument to prevent the safe_put command from blocking indefinitely.
         :param item: item to place in the queue
         :type item: Any
-        :param timeout: max time to wait for a spot to open up in the queue before instead returning False
+        :param timeout: max time to wait for a spot to open up in the queue, under the 'block' policy
         :type timeout: float
-        :return: return True if the item was put in the queue successfully, False if the queue was full
+        :return: return True if the item was put in the queue successfully (even if another item was evicted to make
+            room for it), False if it was dropped
         :rtype: bool
         """
         if self._closed:
             return
         try:
-            self.put(item, block=False, timeout=timeout)
+            if self.overflow.policy == 'block':
+                self.put(item, block=True, timeout=timeout)
+            else:
+                self.put(item, block=False)
             return True
         except Full:
-            return False
+            pass
+        if self.overflow.policy != 'block' and self.overflow.should_evict():
+            if self.evict() is not None:
+                try:
+                    self.put(item, block=False)
+                    return True
+                except Full:
+                    pass
+        OverflowPolicy.count(self.overflow.dropped, len(item) if isinstance(item, ItemBatch) else 1)
+        return False
+
+    def evict(self):
+        """remove the message at the head of the queue to make room for a new one
+        :return: the evicted item (or batch of items), or None if the queue was empty
+        """
+        # items only reach the underlying pipe once the feeder thread flushes them, so wait briefly rather than
+        # reporting a full queue as empty
+        try:
+            item = self.get(block=True, timeout=0.02)
+        except Empty:
+            return None
+        OverflowPolicy.count(self.overflow.evicted, len(item) if isinstance(item, ItemBatch) else 1)
+        return item
 
-    def drain(self):
+    def put_many(self, items, timeout=0.02):
+        """
+        put several items into the queue as a single message, so that the whole batch pays for only one lock
+        acquisition, pickling step, and pipe write. Consumers get the items back one at a time (or with get_many), in
+        order. The batch counts as a single item towards maxsize and the overflow policy. Note that all the items in a
+        batch go to whichever consumer gets the batch, so batches shouldn't be used to share work between several
+        consumers
+        :param items: items to place in the queue
+        :type items: list
+        :param timeout: see safe_put
+        :type timeout: float
+        :return: True if the batch was put in the queue successfully, False if it was dropped
+        :rtype: bool
+        """
+        items = list(items)
+        if not items:
+            return True
+        if len(items) == 1:
+            return self.safe_put(items[0], timeout)
+        return self.safe_put(ItemBatch(items), timeout)
+
+    def get_many(self, max_items=100, timeout=0.02):
+        """
+        get up to max_items items at once. Waits up to timeout seconds (see safe_get) for the first item, then takes
+        whatever else is already available without waiting
+        :param max_items: max number of items to return
+        :type max_items: int
+        :param timeout: max time to wait for the first item
+        :type timeout: float
+        :return: the items, oldest first. Empty if no item arrived in time
+        :rtype: list
+        """
+        items = []
+        while len(items) < max_items:
+            item = self.safe_get(timeout if not items else None)
+            if item is None:
+                break
+            items.append(item)
+        return items
+
+    def drain(self, timeout=0.1):
         """
         safely remove all items from the queue without processing them. Useful for smoothly shutting down other
-        processes that are using a queue.
+        processes that are using a queue. Items are read as fast as the pipe allows, rather than with a timeout per
+        item. The only waiting is for items that have been put but not yet flushed to the pipe by their producer's
+        feeder thread, and is capped at timeout seconds in total
+        :param timeout: max total time to wait for items that are still on their way into the queue
+        :type timeout: float
+        :return: the items that were removed, oldest first
+        :rtype: list
         """
-        item = self.safe_get()
-        while item is not None:
-            yield item
-            item = self.safe_get()
+        items = list(self._pending)
+        self._pending.clear()
+        deadline = time.time() + timeout
+        while not self._closed:
+            try:
+                item = self.get(block=False)
+            except Empty:
+                if self.in_flight() and self.wait(sleep_secs(timeout, deadline)):
+                    continue
+                break
+            items.extend(item if isinstance(item, ItemBatch) else [item])
+        return items
+
+    def in_flight(self):
+        """True if items have been put in the queue that haven't been taken out yet"""
+        try:
+            return self.qsize() > 0
+        except NotImplementedError:
+            # qsize isn't available on some platforms (e.g., macOS)
+            return False
 
     def safe_close(self):
         """
@@ -88,12 +425,314 @@ class MPQueue(mpq.Queue):
         :return: the number of items that were drained from the queue and discarded before exiting
         :rtype: int
         """
-        num_left = sum(1 for __ in self.drain())
+        num_left = len(self.drain())
+        self.close()
+        self.join_thread()
+        return num_left
+
+
+# -- Shared-memory frame transport
+
+FrameRef = namedtuple('FrameRef', ['cap_time', 'slot'])
+
+
+class FrameRingBuffer:
+
+    def __init__(self, n_slots, frame_shape, detect_shape=None, policy='block', every_n=2, name=None):
+        """
+        shared-memory transport for image frames, with an interface that mirrors MPQueue. Each frame is copied into one
+        of n_slots fixed-size blocks of preallocated shared memory, and only a small FrameRef (capture time and slot
+        index) travels through the underlying metadata queue. This avoids pickling each frame and pushing it through a
+        pipe. The consumer reads frames zero-copy as numpy views, and must release each slot once it is finished with
+        it so that the producer can reuse it. Items that are not (cap_time, numpy.ndarray) tuples, such as the string
+        "END", pass through the metadata queue unchanged.
+        :param n_slots: max number of frames that can be held in the buffer at once
+        :type n_slots: int
+        :param frame_shape: shape of each frame, e.g. (height, width, 3) for an RGB image
+        :type frame_shape: tuple[int]
+        :param detect_shape: if set, each slot also holds a second, smaller copy of the frame with this shape, intended
+                             as the detector input. Producers then put (cap_time, frame, detect_frame) tuples
+        :type detect_shape: tuple[int]
+        :param policy: how safe_put handles a full buffer (see OverflowPolicy). Only frames that are still waiting in
+                       the buffer can be evicted, not those the consumer is holding
+        :type policy: str
+        :param every_n: see OverflowPolicy
+        :type every_n: int
+        :param name: name used to identify the buffer in stats snapshots
+        :type name: str
+        """
+        self.n_slots = n_slots
+        self.frame_shape = tuple(frame_shape)
+        self.frame_size = int(np.prod(self.frame_shape))
+        self._shm = mp.RawArray(ctypes.c_uint8, self.n_slots * self.frame_size)
+        self._frames = None
+        self.detect_shape = tuple(detect_shape) if detect_shape else None
+        if self.detect_shape:
+            self._detect_shm = mp.RawArray(ctypes.c_uint8, self.n_slots * int(np.prod(self.detect_shape)))
+        self._detect_frames = None
+        # leave some headroom in the metadata queue for control messages like "END"
+        self.meta_q = MPQueue(maxsize=n_slots + 10, name=name)
+        self.free_q = MPQueue(maxsize=n_slots)
+        for slot in range(n_slots):
+            self.free_q.put(slot)
+        self.overflow = OverflowPolicy(policy, every_n)
+
+    def __getstate__(self):
+        # numpy views can't be pickled into shared memory, so each process rebuilds its own on first access
+        state = self.__dict__.copy()
+        state['_frames'] = None
+        state['_detect_frames'] = None
+        return state
+
+    @property
+    def frames(self):
+        """numpy view of the entire shared block, with shape (n_slots, *frame_shape)"""
+        if self._frames is None:
+            self._frames = np.frombuffer(self._shm, dtype=np.uint8).reshape((self.n_slots,) + self.frame_shape)
+        return self._frames
+
+    @property
+    def detect_frames(self):
+        """numpy view of the entire shared block of detector inputs, with shape (n_slots, *detect_shape)"""
+        if self._detect_frames is None:
+            self._detect_frames = np.frombuffer(self._detect_shm, dtype=np.uint8).reshape(
+                (self.n_slots,) + self.detect_shape)
+        return self._detect_frames
+
+    @property
+    def _closed(self):
+        return self.meta_q._closed
+
+    def qsize(self):
+        return self.meta_q.qsize()
+
+    def occupancy(self):
+        return self.meta_q.qsize() / self.n_slots
+
+    @property
+    def service_secs(self):
+        return self.meta_q.service_secs
+
+    @property
+    def name(self):
+        return self.meta_q.name
+
+    def snapshot(self):
+        """see MPQueue.snapshot. Occupancy and depth count frames waiting in the buffer, but not those held by the
+        consumer"""
+        snapshot = self.meta_q.snapshot()
+        snapshot.update(self.overflow.stats())
+        return snapshot
+
+    @property
+    def producer_interval(self):
+        return self.meta_q.producer_interval
+
+    def safe_put(self, item, timeout=0.02):
+        """
+        copy a frame into a free slot and queue a FrameRef pointing to it. Items other than (cap_time, frame) or
+        (cap_time, frame, detect_frame) tuples are placed in the metadata queue as-is.
+        :param item: (cap_time, frame) tuple, where frame is a numpy array matching self.frame_shape, a
+                     (cap_time, frame, detect_frame) tuple if detect_shape was set, or any other picklable object
+        :type item: Any
+        :param timeout: max time to wait for a slot to be released by the consumer, under the 'block' policy
+        :type timeout: float
+        :return: True if the item was queued successfully, False if it was dropped
+        :rtype: bool
+        """
+        if self._closed:
+            return
+        if not (isinstance(item, tuple) and len(item) in (2, 3) and isinstance(item[1], np.ndarray)):
+            return self.meta_q.safe_put(item, timeout)
+        cap_time, frame = item[:2]
+        slot = self.free_q.safe_get(timeout if self.overflow.policy == 'block' else None)
+        if slot is None and self.overflow.policy != 'block' and self.overflow.should_evict():
+            if self.evict() is not None:
+                slot = self.free_q.safe_get(timeout)
+        if slot is None:
+            OverflowPolicy.count(self.overflow.dropped)
+            return False
+        self.frames[slot][...] = frame
+        if self.detect_shape:
+            self.detect_frames[slot][...] = item[2]
+        if self.meta_q.safe_put(FrameRef(cap_time, slot), timeout):
+            return True
+        self.free_q.safe_put(slot)
+        return False
+
+    def safe_get(self, timeout=0.02):
+        """
+        get the next item from the metadata queue. See MPQueue.safe_get
+        :return: a FrameRef (which can be passed to view() and release()), any other queued item, or None
+        """
+        return self.meta_q.safe_get(timeout)
+
+    def get_many(self, max_items=100, timeout=0.02):
+        """see MPQueue.get_many"""
+        return self.meta_q.get_many(max_items, timeout)
+
+    def wait(self, timeout=None, wakeup=None):
+        """see MPQueue.wait"""
+        return self.meta_q.wait(timeout, wakeup)
+
+    def wait_get(self, timeout=None, wakeup=None):
+        """see MPQueue.wait_get"""
+        return self.meta_q.wait_get(timeout, wakeup)
+
+    def view(self, frame_ref):
+        """
+        zero-copy numpy view of the frame referenced by frame_ref. Only valid until release(frame_ref) is called
+        :param frame_ref: reference returned by safe_get
+        :type frame_ref: FrameRef
+        :rtype: numpy.ndarray
+        """
+        return self.frames[frame_ref.slot]
+
+    def detect_view(self, frame_ref):
+        """
+        zero-copy numpy view of the detector input that was stored alongside the frame referenced by frame_ref. Only
+        available if detect_shape was set, and only valid until release(frame_ref) is called
+        :param frame_ref: reference returned by safe_get
+        :type frame_ref: FrameRef
+        :rtype: numpy.ndarray
+        """
+        return self.detect_frames[frame_ref.slot]
+
+    def evict(self):
+        """release the slot of the oldest frame waiting in the buffer, so that it can be reused
+        :return: the evicted FrameRef, or None if there were no frames waiting
+        """
+        item = self.meta_q.safe_get()
+        if item is None:
+            return None
+        if not isinstance(item, FrameRef):
+            # control messages are never evicted. This breaks their ordering with the frames, but only happens if
+            # frames are still being put after a message like "END"
+            self.meta_q.safe_put(item)
+            return None
+        self.release(item)
+        OverflowPolicy.count(self.overflow.evicted)
+        return item
+
+    def release(self, frame_ref):
+        """
+        return the slot referenced by frame_ref to the pool of free slots
+        :param frame_ref: reference returned by safe_get
+        :type frame_ref: FrameRef
+        """
+        self.free_q.safe_put(frame_ref.slot)
+
+    def drain(self, timeout=0.1):
+        """
+        see MPQueue.drain. Slots held by drained frames are released automatically
+        """
+        items = self.meta_q.drain(timeout)
+        for item in items:
+            if isinstance(item, FrameRef):
+                self.release(item)
+        return items
+
+    def close(self):
+        self.meta_q.close()
+        self.free_q.close()
+
+    def join_thread(self):
+        self.meta_q.join_thread()
+        self.free_q.join_thread()
+
+    def safe_close(self):
+        """
+        see MPQueue.safe_close
+        """
+        num_left = len(self.drain())
         self.close()
         self.join_thread()
         return num_left
 
 
+# -- Shared inference support
+
+InferenceRequest = namedtuple('InferenceRequest', ['client', 'seq', 'shape', 'scale', 'conf_thresh', 'submit_time'])
+InferenceResponse = namedtuple('InferenceResponse', ['seq', 'dets', 'queue_secs'])
+
+
+class InferenceUnavailable(Exception):
+    """raised by InferenceClient.detect when a request could not be sent to, or was not answered by, the server"""
+    pass
+
+
+class InferenceClient:
+
+    def __init__(self, name, priority, input_shape, request_q, timeout=10):
+        """
+        one client's connection to an InferenceServerWorker. Images travel through a block of shared memory sized to
+        the model input, and only a small InferenceRequest goes through the request queue, which is shared by all
+        clients of the same server. Each client has at most one request outstanding at a time. Has the same
+        input_size attribute and detect method as the backends in inference.py, so a DetectorWorker can use it in place
+        of an interpreter of its own
+        :param name: name of the client. Must be unique among the clients of a server
+        :type name: str
+        :param priority: requests from clients with a lower priority value are served first
+        :type priority: int
+        :param input_shape: shape of the model input, i.e., (height, width, 3)
+        :type input_shape: tuple[int]
+        :param request_q: queue through which requests are sent to the server
+        :type request_q: MPQueue
+        :param timeout: max time, in seconds, to wait for the server to respond to a request
+        :type timeout: float
+        """
+        self.name, self.priority = name, priority
+        self.input_shape = tuple(input_shape)
+        self.input_size = (self.input_shape[1], self.input_shape[0])
+        self._shm = mp.RawArray(ctypes.c_uint8, int(np.prod(self.input_shape)))
+        self._inputs = None
+        self.request_q = request_q
+        self.response_q = MPQueue(maxsize=10, name=f'{name}_responses')
+        self.timeout = timeout
+        self.seq = 0
+        # requests and queue_secs are recorded by the server, failures by the client
+        self.stats = SharedStats(['requests', 'failures'], {'queue_secs': SharedStats.TIME_BINS})
+
+    def __getstate__(self):
+        # see FrameRingBuffer.__getstate__
+        state = self.__dict__.copy()
+        state['_inputs'] = None
+        return state
+
+    def __str__(self):
+        return f'inference server, as client {self.name} with priority {self.priority}'
+
+    @property
+    def inputs(self):
+        """numpy view of the shared input block, with shape input_shape"""
+        if self._inputs is None:
+            self._inputs = np.frombuffer(self._shm, dtype=np.uint8).reshape(self.input_shape)
+        return self._inputs
+
+    def detect(self, resized, scale, conf_thresh):
+        """
+        send an image to the server and wait for the detections. See inference.InferenceBackend.detect. Raises
+        InferenceUnavailable if the request queue is full or the server does not respond within self.timeout
+        """
+        height, width = resized.shape[:2]
+        self.inputs[:height, :width] = resized
+        self.seq += 1
+        request = InferenceRequest(self.name, self.seq, (height, width), scale, conf_thresh, time.time())
+        if not self.request_q.safe_put(request):
+            self.stats.incr('failures')
+            raise InferenceUnavailable('inference request dropped, the request queue is full')
+        deadline = time.time() + self.timeout
+        while True:
+            response = self.response_q.safe_get(timeout=sleep_secs(self.timeout, deadline))
+            if response is None:
+                self.stats.incr('failures')
+                raise InferenceUnavailable(f'no response from the inference server within {self.timeout} seconds')
+            # responses to earlier requests that timed out may still turn up, and are skipped
+            if response.seq == self.seq:
+                break
+        return response.dets
+
+
 # -- useful function
 def sleep_secs(max_sleep, end_time=999999999999999.9):
     """
@@ -136,6 +775,40 @@ class EventMessage:
         return f"{self.msg_src:10} - {self.msg_type:10} : {self.msg}"
 
 
+# -- Shutdown signalling
+class ShutdownEvent:
+
+    def __init__(self):
+        """
+        multiprocessing.Event that can also be waited on alongside queues (see MPQueue.wait). Setting the event writes a
+        byte to a pipe, and the read end of the pipe stays readable from then on, so that any process blocked in
+        multiprocessing.connection.wait wakes immediately. Unlike a regular Event, it cannot be cleared
+        """
+        self._event = mp.Event()
+        self._reader, self._writer = mp.Pipe(duplex=False)
+
+    def set(self):
+        if not self._event.is_set():
+            self._event.set()
+            if not self._writer.closed:
+                self._writer.send_bytes(b'\x00')
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def close(self):
+        """close this process's ends of the pipe. The event itself can still be set and checked afterwards, but can no
+        longer be waited on alongside queues"""
+        self._reader.close()
+        self._writer.close()
+
+
 # -- Signal Handling
 class TerminateInterrupt(BaseException):
     pass
@@ -175,7 +848,7 @@ class ProcWorker(metaclass=gen_utils.AutologMetaclass):
     int_handler = staticmethod(default_signal_handler)   # interrupt signal handler
     term_handler = staticmethod(default_signal_handler)  # terminate signal handler
 
-    def __init__(self, name, startup_event, shutdown_event, event_q, metadata, *args):
+    def __init__(self, name, startup_event, shutdown_event, event_q, metadata, *args, stats=None):
         """
         Worker process base class. Most methods will be overridden in derived classes, except for "__init__" and "run"
         :param name: descriptive name for the worker process
@@ -183,13 +856,16 @@ class ProcWorker(metaclass=gen_utils.AutologMetaclass):
         :param startup_event: event used to signal to the parent that the worker process started successfully
         :type startup_event: multiprocessing.Event
         :param shutdown_event: event used to signal to the worker that it should shut down
-        :type shutdown_event: multiprocessing.Event
+        :type shutdown_event: ShutdownEvent
         :param event_q: queue used to communicate complex messages with the parent class
         :type event_q: MPQueue
         :param metadata: project metadata dictionary, as returned by metadata.MetaDataHandler.simplify()
         :type metadata: dict[str, Union[str, dict[str, str]]]
         :param args: additional arguments handled by the init_args method of derived classes
         :type args: Any
+        :param stats: if given, the number of main_func calls and the time spent in them are recorded here (see
+                      make_worker_stats)
+        :type stats: SharedStats
         """
         self.name = name
         self.metadata = metadata
@@ -200,6 +876,7 @@ class ProcWorker(metaclass=gen_utils.AutologMetaclass):
         self.shutdown_event = shutdown_event
         self.event_q = event_q
         self.terminate_called = 0
+        self.stats = stats
         self.init_args(args)
 
     def init_args(self, args):
@@ -250,6 +927,8 @@ class ProcWorker(metaclass=gen_utils.AutologMetaclass):
         self.init_signals()
         try:
             self.startup()
+            if self.stats is not None:
+                self.main_func = self.timed(self.main_func)
             self.startup_event.set()
             self.main_loop()
             self.logger.log(logging.INFO, "Normal Shutdown")
@@ -262,6 +941,27 @@ class ProcWorker(metaclass=gen_utils.AutologMetaclass):
             self.shutdown()
 
 
+    def timed(self, main_func):
+        """wrap main_func so that each call is counted, and its run time recorded, in self.stats"""
+        @functools.wraps(main_func)
+        def wrapper(*args):
+            start = time.monotonic()
+            try:
+                return main_func(*args)
+            finally:
+                elapsed = time.monotonic() - start
+                self.stats.incr('loops')
+                self.stats.incr('busy_secs', elapsed)
+                self.stats.record('main_func_secs', elapsed)
+                self.stats.set('last_loop_time', time.time())
+        return wrapper
+
+
+def make_worker_stats():
+    """shared stats for a ProcWorker. Created by the parent process, so that it can keep reading them"""
+    return SharedStats(['loops', 'busy_secs', 'last_loop_time'], {'main_func_secs': SharedStats.TIME_BINS})
+
+
 class TimerProcWorker(ProcWorker, metaclass=gen_utils.AutologMetaclass):
     """
     Basic worker process class for processes where the main function should run at set intervals (determined by
@@ -270,19 +970,18 @@ class TimerProcWorker(ProcWorker, metaclass=gen_utils.AutologMetaclass):
     example.
     """
     INTERVAL_SECS = 10  # default interval at which the main loop runs
-    MAX_SLEEP_SECS = 0.02  # default interval at which the process checks whether it should run the main loop
 
     def main_loop(self):
-        # determine when the main_func method should be called again
-        next_time = time.time() + self.INTERVAL_SECS
-        # repeatedly (and frequently) check if another process is trying to shut this process down
-        while not self.shutdown_event.is_set():
-            # sleep for MAX_SLEEP_SECS or until next_time, whichever is smaller
-            time.sleep(sleep_secs(self.MAX_SLEEP_SECS, next_time))
-            # if the current time exceeds next_time, run the main function and update next_time
-            if time.time() > next_time:
-                self.main_func()
-                next_time = time.time() + self.INTERVAL_SECS
+        # main_func runs on a fixed schedule of deadlines on the monotonic clock, so the time main_func itself takes
+        # doesn't add drift. Between deadlines, the process sleeps on the shutdown event, which wakes it immediately if
+        # another process is trying to shut it down
+        next_time = time.monotonic() + self.INTERVAL_SECS
+        while not self.shutdown_event.wait(max(0.0, next_time - time.monotonic())):
+            self.main_func()
+            next_time += self.INTERVAL_SECS
+            if next_time <= time.monotonic():
+                # main_func overran the interval. Start a new schedule instead of running back-to-back to catch up
+                next_time = time.monotonic() + self.INTERVAL_SECS
 
 
 class QueueProcWorker(ProcWorker, metaclass=gen_utils.AutologMetaclass):
@@ -300,11 +999,12 @@ class QueueProcWorker(ProcWorker, metaclass=gen_utils.AutologMetaclass):
     def main_loop(self):
         """
         While the shutdown event is not set, this method takes an item from the work queue and passes it to the
-        main_func method. If the queue is empty, continues without throwing an error. If the queue item is the string
-        "END", breaks the main loop, which triggers the process to shut down gracefully.
+        main_func method. While the queue is empty, the process sleeps until either an item arrives or the shutdown
+        event is set. If the queue item is the string "END", breaks the main loop, which triggers the process to shut down
+        gracefully.
         """
         while not self.shutdown_event.is_set():
-            item = self.work_q.safe_get()
+            item = self.work_q.wait_get(wakeup=self.shutdown_event)
             if not item:
                 continue
             self.logger.debug(f"QueueProcWorker.main_loop received '{item}' message")
@@ -314,9 +1014,72 @@ class QueueProcWorker(ProcWorker, metaclass=gen_utils.AutologMetaclass):
                 self.main_func(item)
 
 
+class InferenceServerWorker(ProcWorker, metaclass=gen_utils.AutologMetaclass):
+    """
+    Worker class for a process that owns the inference backend (and therefore the Edge TPU) for the whole host, and
+    serves detection requests from any number of InferenceClients. Waiting requests are served in order of client
+    priority, and in order of arrival among clients with the same priority. Since each client has at most one request
+    outstanding, clients with the same priority take turns. Edge TPU models process a single image at a time, so
+    requests are interleaved rather than batched.
+    """
+    def init_args(self, args):
+        """
+        :param args: the request queue shared by the clients, the list of InferenceClients, and the arguments to pass
+                     to inference.make_backend
+        """
+        self.request_q, clients, self.backend_args = args
+        self.clients = {client.name: client for client in clients}
+
+    def startup(self):
+        # imported here so that mptools does not depend on the model runtime
+        from internet_of_fish.modules import inference
+        self.backend, _ = inference.make_backend(*self.backend_args)
+        self.logger.info(f'inference server running the {self.backend} for clients {", ".join(self.clients)}')
+        self.pending = []
+        self.request_count = 0
+
+    def main_func(self):
+        # collect everything that has arrived, so that the next request is chosen by priority rather than arrival
+        if self.pending:
+            request = self.request_q.safe_get(timeout=None)
+        else:
+            # idle, so sleep until a request arrives or the server is shut down
+            request = self.request_q.wait_get(wakeup=self.shutdown_event)
+        while request is not None:
+            self.pending.append(request)
+            request = self.request_q.safe_get(timeout=None)
+        if not self.pending:
+            return
+        request = min(self.pending, key=lambda r: (self.clients[r.client].priority, r.submit_time))
+        self.pending.remove(request)
+        client = self.clients[request.client]
+        queue_secs = time.time() - request.submit_time
+        height, width = request.shape
+        dets = self.backend.detect(client.inputs[:height, :width], request.scale, request.conf_thresh)
+        client.response_q.safe_put(InferenceResponse(request.seq, dets, queue_secs))
+        client.stats.incr('requests')
+        client.stats.record('queue_secs', queue_secs)
+        self.request_count += 1
+        if not self.request_count % 1000:
+            self.print_info()
+
+    def print_info(self):
+        for name, client in self.clients.items():
+            stats = client.stats.snapshot()
+            if stats['requests']:
+                queue_p50 = SharedStats.quantile(stats['queue_secs'], 0.5)
+                self.logger.info(f'client {name}: {stats["requests"]:.0f} requests served, median queueing delay '
+                                 f'<{queue_p50 * 1000:.1f}ms')
+
+    def shutdown(self):
+        self.print_info()
+        self.request_q.close()
+        self.event_q.close()
+
+
 # -- Process Wrapper
 
-def proc_worker_wrapper(proc_worker_class, name, startup_evt, shutdown_evt, event_q, metadata, *args):
+def proc_worker_wrapper(proc_worker_class, name, startup_evt, shutdown_evt, event_q, metadata, *args, **kwargs):
     """
     wrapper to facilitate passing process worker classes as the "target" keyword argument of multiprocessing.Proc
     :param proc_worker_class: the process worker class to wrap
@@ -330,12 +1093,75 @@ def proc_worker_wrapper(proc_worker_class, name, startup_evt, shutdown_evt, even
     :param event_q:
     :param metadata:
     :param args:
+    :param kwargs: keyword arguments passed to the proc_worker __init__ (e.g., stats)
     :return:
     """
-    proc_worker = proc_worker_class(name, startup_evt, shutdown_evt, event_q, metadata, *args)
+    proc_worker = proc_worker_class(name, startup_evt, shutdown_evt, event_q, metadata, *args, **kwargs)
     return proc_worker.run()
 
 
+def wait_for_procs(procs, timeout):
+    """
+    wait on several procs at once, returning as soon as they have all exited or the timeout expires
+    :param procs: procs to wait on
+    :type procs: list[Proc]
+    :param timeout: max time to wait, in seconds
+    :type timeout: float
+    :return: seconds from the start of the wait until each proc exited, by proc name. Procs that were still running
+             at the timeout are left out
+    :rtype: dict[str, float]
+    """
+    start = time.time()
+    end_time = start + timeout
+    exit_secs = {}
+    running = {}
+    for proc in procs:
+        if proc.proc.is_alive():
+            running[proc.proc.sentinel] = proc
+        else:
+            exit_secs[proc.name] = 0.0
+    while running:
+        exited = mp.connection.wait(list(running), sleep_secs(timeout, end_time))
+        if not exited:
+            break
+        for sentinel in exited:
+            proc = running.pop(sentinel)
+            proc.proc.join()
+            exit_secs[proc.name] = time.time() - start
+    return exit_secs
+
+
+def terminate_procs(procs, wait_secs):
+    """
+    force procs to exit, by sending each one SIGTERM, then sending SIGKILL to any still running after wait_secs. All
+    the procs are signalled together, so the whole thing takes at most 2 * wait_secs however many procs there are
+    :param procs: procs to terminate
+    :type procs: list[Proc]
+    :param wait_secs: time to wait after each signal, in seconds
+    :type wait_secs: float
+    :return: seconds from the first signal until each proc exited, by proc name (see wait_for_procs). Procs that were
+             still running after SIGKILL are left out
+    :rtype: dict[str, float]
+    """
+    start = time.time()
+    exit_secs = {}
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        procs = [proc for proc in procs if proc.name not in exit_secs]
+        if not procs:
+            break
+        for proc in procs:
+            if proc.proc.is_alive():
+                proc.logger.debug(f'sending {sig.name} to {proc.name}')
+                if sig == signal.SIGTERM:
+                    proc.proc.terminate()
+                else:
+                    proc.proc.kill()
+        signal_secs = time.time() - start
+        for name, secs in wait_for_procs(procs, wait_secs).items():
+            exit_secs[name] = signal_secs + secs
+    return exit_secs
+
+
 class Proc(metaclass=gen_utils.AutologMetaclass):
 
     def __init__(self, name, worker_class, shutdown_event, event_q, metadata, *args):
@@ -347,8 +1173,10 @@ class Proc(metaclass=gen_utils.AutologMetaclass):
         self.name = name
         self.shutdown_event = shutdown_event
         self.startup_event = mp.Event()
+        self.stats = make_worker_stats()
         self.proc = mp.Process(target=proc_worker_wrapper,
-                               args=(worker_class, name, self.startup_event, shutdown_event, event_q, metadata, *args))
+                               args=(worker_class, name, self.startup_event, shutdown_event, event_q, metadata, *args),
+                               kwargs={'stats': self.stats})
         self.logger.debug(f"Proc.__init__ starting : {name}")
         self.proc.start()
         started = self.startup_event.wait(timeout=self.STARTUP_WAIT_SECS)
@@ -365,19 +1193,11 @@ class Proc(metaclass=gen_utils.AutologMetaclass):
             self.terminate()
 
     def terminate(self):
-        tries = self.defs.MAX_TRIES
-        while tries and self.proc.is_alive():
-            self.proc.terminate()
-            time.sleep(0.1)
-            tries -= 1
-
-        if self.proc.is_alive():
-            self.logger.log(logging.ERROR, f"Proc.terminate failed to terminate {self.name} after "
-                                           f"{self.defs.MAX_TRIES} attempts")
+        if self.name not in terminate_procs([self], self.defs.TERMINATE_WAIT_SECS):
+            self.logger.log(logging.ERROR, f"Proc.terminate failed to terminate {self.name}")
             return False
         else:
-            self.logger.log(logging.INFO, f"Proc.terminate terminated {self.name} after "
-                                          f"{self.defs.MAX_TRIES - tries} attempt(s)")
+            self.logger.log(logging.INFO, f"Proc.terminate terminated {self.name}")
             return True
 
     def __enter__(self):
@@ -399,12 +1219,14 @@ class MainContext(metaclass=gen_utils.AutologMetaclass):
         self.STOP_WAIT_SECS = self.defs.DEFAULT_SHUTDOWN_WAIT_SECS
         self.procs = []
         self.queues = []
-        self.shutdown_event = mp.Event()
-        self.event_queue = self.MPQueue()
+        self.clients = []
+        self.shutdown_event = ShutdownEvent()
+        self.event_queue = self.MPQueue(name='events')
         self._init_specials()
 
     def _init_specials(self):
-        self.notification_q = self.MPQueue()
+        # notifications are rare but important, so they are never dropped to make room
+        self.notification_q = self.MPQueue(policy='block', name='notifications')
         self.logger = gen_utils.make_logger('MAINCONTEXT')
 
     def __enter__(self):
@@ -416,6 +1238,7 @@ class MainContext(metaclass=gen_utils.AutologMetaclass):
             self.logger.log(logging.ERROR, f"Exception: {exc_val}", exc_info=(exc_type, exc_val, exc_tb))
         self._stopped_procs_result = self.stop_all_procs()
         self._stopped_queues_result = self.stop_all_queues()
+        self.shutdown_event.close()
         self.logger.info('.'*40)
 
         # -- Don't eat exceptions that reach here.
@@ -431,35 +1254,105 @@ class MainContext(metaclass=gen_utils.AutologMetaclass):
         self.queues.append(q)
         return q
 
-    def stop_procs(self, procs, stop_wait_secs=None):
+    def FrameRingBuffer(self, *args, **kwargs):
+        q = FrameRingBuffer(*args, **kwargs)
+        self.queues.append(q)
+        return q
+
+    def InferenceClient(self, *args, **kwargs):
+        client = InferenceClient(*args, **kwargs)
+        self.clients.append(client)
+        self.queues.append(client.response_q)
+        return client
+
+    def snapshot(self):
+        """
+        gather the stats of every process and queue in the context (see SharedStats). The stats live in shared memory,
+        so none of the processes are interrupted
+        :return: {'procs': {proc name: stats}, 'queues': {queue name: stats}, 'clients': {client name: stats}}.
+                 Unnamed queues are labelled by position. Client stats cover the requests each InferenceClient made
+                 to the inference server, including how long they waited in its queue
+        :rtype: dict
+        """
+        return {'procs': {proc.name: proc.stats.snapshot() for proc in self.procs},
+                'queues': {q.name or f'queue{i}': q.snapshot() for i, q in enumerate(self.queues)},
+                'clients': {client.name: client.stats.snapshot() for client in self.clients}}
+
+    def log_snapshot(self):
+        """log a one line summary of the stats of each process and queue in the context (see snapshot)"""
+        snapshot = self.snapshot()
+        for name, stats in snapshot['procs'].items():
+            if not stats['loops']:
+                continue
+            p50, p95 = (SharedStats.quantile(stats['main_func_secs'], q) for q in (0.5, 0.95))
+            busy_frac = stats['busy_secs'] / stats['uptime_secs']
+            self.logger.info(f'{name}: {stats["loops"]:.0f} loops, busy {busy_frac:.0%} of the time, main_func p50 '
+                             f'<{p50 * 1000:.1f}ms, p95 <{p95 * 1000:.1f}ms')
+        for name, stats in snapshot['queues'].items():
+            if not stats['put']:
+                continue
+            wait_p95 = SharedStats.quantile(stats['wait_secs'], 0.95)
+            wait_str = f', p95 wait <{wait_p95 * 1000:.1f}ms' if wait_p95 is not None else ''
+            if stats['producer_interval']:
+                wait_str += (f', producer interval {stats["producer_interval"]:.3f}s, consumer service time '
+                             f'{stats["service_secs"]:.3f}s')
+            self.logger.info(f'{name}: {stats["put"]:.0f} put, {stats["got"]:.0f} taken, depth {stats["depth"]}'
+                             f'{wait_str}, {stats["dropped"]} dropped, {stats["evicted"]} evicted')
+        for name, stats in snapshot['clients'].items():
+            if not stats['requests'] and not stats['failures']:
+                continue
+            queue_p50, queue_p95 = (SharedStats.quantile(stats['queue_secs'], q) for q in (0.5, 0.95))
+            queue_str = f', queueing delay p50 <{queue_p50 * 1000:.1f}ms, p95 <{queue_p95 * 1000:.1f}ms' \
+                if queue_p50 is not None else ''
+            self.logger.info(f'inference client {name}: {stats["requests"]:.0f} requests served{queue_str}, '
+                             f'{stats["failures"]:.0f} failed')
+
+    def stop_procs(self, procs=None, stop_wait_secs=None):
+        """
+        wait for procs to exit (normally after the shutdown event has been set), then terminate any stragglers. All
+        the procs are waited on together against a single deadline, so this takes about as long as the slowest proc
+        rather than the sum of all of them. Logs how long each proc took to stop
+        :param procs: procs to stop. Defaults to all procs in the context
+        :type procs: list[Proc]
+        :param stop_wait_secs: time to wait for the procs to exit on their own before terminating them. Defaults to
+                               STOP_WAIT_SECS
+        :type stop_wait_secs: float
+        :return: number of procs that exited with an error, and number of procs that had to be terminated
+        :rtype: tuple[int, int]
+        """
+        procs = list(self.procs if procs is None else procs)
         stop_wait_secs = stop_wait_secs if stop_wait_secs else self.STOP_WAIT_SECS
-        end_time = time.time() + stop_wait_secs
+        start = time.time()
+        self.logger.debug(f'waiting up to {stop_wait_secs}s for {" ".join([proc.name for proc in procs])} to stop')
+        exit_secs = wait_for_procs(procs, stop_wait_secs)
+        stragglers = [proc for proc in procs if proc.name not in exit_secs]
+        if stragglers:
+            self.logger.warning(f'terminating {" ".join([proc.name for proc in stragglers])} after waiting '
+                                f'{stop_wait_secs}s for them to stop')
+            terminate_start = time.time() - start
+            for name, secs in terminate_procs(stragglers, self.defs.TERMINATE_WAIT_SECS).items():
+                exit_secs[name] = terminate_start + secs
+
         num_terminated = 0
         num_failed = 0
-        # wait up to STOP_WAIT_SECS for all processes to complete
-        for proc in procs:
-            join_secs = sleep_secs(stop_wait_secs, end_time)
-            self.logger.debug(f'attempting to join {proc.name}. timing out in {join_secs:.2}')
-            proc.proc.join(join_secs)
-        # quickly try to join each proc once more. Useful for long proc lists with high stop_wait_secs, as some procs
-        # may finish after the first join attempt, but before the final join on the final proc times out
-        [proc.proc.join(0.2) for proc in procs]
-        # terminate any procs that failed to join
         dead_procs = []
-        while procs:
-            proc = procs.pop()
+        for proc in procs:
             if proc.proc.is_alive():
-                if proc.terminate():
-                    num_terminated += 1
-                    dead_procs.append(proc)
+                self.logger.error(f"Process {proc.name} could not be terminated")
+                continue
+            dead_procs.append(proc)
+            if proc in stragglers:
+                num_terminated += 1
+                self.logger.info(f"Process {proc.name} terminated after "
+                                 f"{exit_secs.get(proc.name, time.time() - start):.2f}s")
+            elif proc.proc.exitcode:
+                num_failed += 1
+                self.logger.error(f"Process {proc.name} ended with exitcode {proc.proc.exitcode} after "
+                                  f"{exit_secs[proc.name]:.2f}s")
             else:
-                dead_procs.append(proc)
-                exitcode = proc.proc.exitcode
-                if exitcode:
-                    self.logger.error(f"Process {proc.name} ended with exitcode {exitcode}")
-                    num_failed += 1
-                else:
-                    self.logger.debug(f"Process {proc.name} stopped successfully")
+                self.logger.info(f"Process {proc.name} stopped in {exit_secs[proc.name]:.2f}s")
+        if procs:
+            self.logger.info(f'stopped {len(dead_procs)} of {len(procs)} procs in {time.time() - start:.2f}s')
 
         self.procs = [proc for proc in self.procs if proc not in dead_procs]
         return num_failed, num_terminated
@@ -475,7 +1368,7 @@ class MainContext(metaclass=gen_utils.AutologMetaclass):
 
     def stop_all_procs(self, **kwargs):
         self.shutdown_event.set()
-        num_failed, num_terminated = self.stop_procs(self.procs, kwargs)
+        num_failed, num_terminated = self.stop_procs(self.procs, **kwargs)
         return num_failed, num_terminated
 
     def stop_all_queues(self):
@@ -483,7 +1376,9 @@ class MainContext(metaclass=gen_utils.AutologMetaclass):
         self.shutdown_event.set()
         # -- Clear the queues list and close all associated queues
         for q in self.queues:
-            num_items_left += sum(1 for __ in q.drain())
+            if q.overflow.dropped.value or q.overflow.evicted.value:
+                self.logger.info(f'{q.name or q.__class__.__name__} closed with {q.overflow}')
+            num_items_left += len(q.drain())
             q.close()
 
         # -- Wait for all queue threads to stop
@@ -4,6 +4,9 @@ from internet_of_fish.modules.utils import file_utils
 from internet_of_fish.modules import mptools
 from internet_of_fish.modules import collector
 from internet_of_fish.modules import detector
+from internet_of_fish.modules import inference
+from internet_of_fish.modules import clip_writer
+from internet_of_fish.modules import detections
 from internet_of_fish.modules.utils import gen_utils
 from internet_of_fish.modules import uploader
 from internet_of_fish.modules import notifier
@@ -29,12 +32,19 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
 
     def startup(self):
         self.event_types = EVENT_TYPES
+        # max time the runner sleeps while waiting for an event, before it checks for override files and mode changes
+        self.EVENT_WAIT_SECS = 1.0
+        # max time to wait for room in the notification queue before a notification is dropped
+        self.NOTIFY_PUT_SECS = 10
         self.MAX_UPLOAD_WORKERS = self.defs.MAX_UPLOAD_WORKERS
         # self.STATUS_INTERVAL = self.defs.STATUS_INTERVAL
         # self.status_report_deadline = time.time() + self.STATUS_INTERVAL
         self.last_event = None
 
         self.main_ctx.Proc('NOTIFY', notifier.NotifierWorker, self.main_ctx.notification_q)
+        self.inference_clients = {}
+        if self.metadata['model_id'] and self.defs.INFERENCE_SERVER:
+            self.start_inference_server()
         # self.status_queue = self.main_ctx.MPQueue(maxsize=10)
         # self.main_ctx.Proc('WATCH', watcher.WatcherWorker, self.status_queue)
         self.secondary_ctx = None
@@ -63,18 +73,20 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
                 self.event_q.safe_put(mptools.EventMessage(self.name, f'{event_type}',
                                                            f'{event_type} override detected'))
 
-        event = self.event_q.safe_get()
+        event = self.event_q.wait_get(self.EVENT_WAIT_SECS, self.shutdown_event)
         if event:
             self.logger.debug(f'Runner received event: {event}')
             self.last_event = event
         if not event:
             self.verify_mode()
         elif event.msg_type == 'NOTIFY':
-            self.main_ctx.notification_q.safe_put(notifier.Notification(event.msg_src, *event.msg))
+            if not self.main_ctx.notification_q.safe_put(notifier.Notification(event.msg_src, *event.msg),
+                                                         timeout=self.NOTIFY_PUT_SECS):
+                self.logger.warning(f'notification queue full. dropped notification: {event.msg}')
         elif event.msg_type == 'FATAL':
             self.logger.info(f'{event.msg_type.title()} event received. Rebooting machine')
             note = notifier.Notification(event.msg_src, event.msg_type, event.msg, self.defs.SUMMARY_LOG_FILE)
-            self.main_ctx.notification_q.safe_put(note)
+            self.main_ctx.notification_q.safe_put(note, timeout=self.NOTIFY_PUT_SECS)
             sp.run(['sudo', 'shutdown', '-r', '+5'])
             self.hard_shutdown()
         elif event.msg_type in 'HARD_SHUTDOWN':
@@ -106,8 +118,6 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
         if self.curr_mode == 'active':
             if self.expected_mode() == 'passive':
                 self.event_q.safe_put(mptools.EventMessage(self.name, 'ENTER_PASSIVE_MODE', 'mode switch'))
-            else:
-                time.sleep(0.1)
         elif self.curr_mode == 'passive':
             if self.expected_mode() == 'active':
                 self.event_q.safe_put(mptools.EventMessage(self.name, 'ENTER_ACTIVE_MODE', 'mode switch'))
@@ -115,8 +125,8 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
                 sleep_time = self.sleep_until_morning()
                 self.logger.info(f'no change in mode. going back to sleep for {sleep_time} seconds')
                 pathlib.Path(self.defs.PROJ_JSON_FILE).touch()
-
-                time.sleep(sleep_time)
+                # wake early if an event arrives in the meantime
+                self.event_q.wait(sleep_time, self.shutdown_event)
 
     def expected_mode(self):
         if self.metadata['source'] or self.metadata['demo'] or self.metadata['test']:
@@ -142,23 +152,76 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
 
     def active_mode(self):
         self.switch_mode('active')
-        self.img_q = self.secondary_ctx.MPQueue(maxsize=30)
+        if self.metadata['model_id'] and not self.metadata['source']:
+            frame_shape = (self.defs.V_RESOLUTION, self.defs.H_RESOLUTION, 3)
+            detect_shape = None
+            input_size = self.detector_input_size() if self.defs.DETECT_STREAM else None
+            if input_size:
+                width, height = detector.detect_resolution((self.defs.H_RESOLUTION, self.defs.V_RESOLUTION),
+                                                           input_size)
+                detect_shape = (height, width, 3)
+                self.logger.debug(f'detector will receive a second camera stream at {width}x{height}')
+            elif self.defs.DETECT_STREAM:
+                self.logger.info('could not determine the model input size, so the detector will downscale the full '
+                                 'resolution frames itself rather than receive a second camera stream')
+            # when the detector falls behind, the stalest frames are the least useful, so they make way for new ones
+            self.img_q = self.secondary_ctx.FrameRingBuffer(30, frame_shape, detect_shape, policy='drop_oldest',
+                                                            name='frames')
+            # lets the detector ask the collector for a clip cut from the live h264 stream
+            self.clip_trigger_q = self.secondary_ctx.MPQueue(maxsize=10, name='clip_triggers')
+        else:
+            # frames from a source video are never dropped. The collector waits for the detector instead
+            self.img_q = self.secondary_ctx.MPQueue(maxsize=30, policy='block', name='frames')
+            self.clip_trigger_q = None
         if self.metadata['source']:
             self.secondary_ctx.Proc('COLLECT', collector.SourceCollectorWorker, self.img_q, self.metadata['source'])
         elif not self.metadata['model_id']:
             self.secondary_ctx.Proc('COLLECT', collector.SimpleCollectorWorker, self.img_q)
         else:
-            self.secondary_ctx.Proc('COLLECT', collector.CollectorWorker, self.img_q)
+            self.secondary_ctx.Proc('COLLECT', collector.CollectorWorker, self.img_q, self.clip_trigger_q)
         if self.metadata['model_id']:
-            self.secondary_ctx.Proc('DETECT', detector.DetectorWorker, self.img_q)
+            # clips arrive as a request followed by chunks of frames, and a dropped chunk would leave a gap in the clip
+            self.clip_q = self.secondary_ctx.MPQueue(policy='block', name='clips')
+            self.secondary_ctx.Proc('CLIP', clip_writer.ClipWriterWorker, self.clip_q)
+            # source videos are backfill work, so live detection (if any) takes priority on the inference server
+            client = self.inference_clients.get('backfill' if self.metadata['source'] else 'live')
+            self.secondary_ctx.Proc('DETECT', detector.DetectorWorker, self.img_q, self.clip_q, self.clip_trigger_q,
+                                    client)
         else:
             self.logger.debug('model_id not set, skipping detector initialization')
         self.logger.info('successfully entered active mode')
 
+    def detector_input_size(self):
+        """(width, height) of the detector's model input, taken from the inference client if there is one (see
+        start_inference_server), or None if it cannot be determined without loading the model"""
+        if self.inference_clients:
+            return self.inference_clients['live'].input_size
+        return inference.model_input_size(self.defs.MODELS_DIR, self.metadata['model_id'],
+                                          self.defs.INFERENCE_BACKEND)
+
+    def start_inference_server(self):
+        """start a single inference server for the host, which loads the model once and keeps it loaded across mode
+        switches. Detectors connect to it through the clients created here, with live detection ahead of backfill"""
+        input_size = inference.model_input_size(self.defs.MODELS_DIR, self.metadata['model_id'],
+                                                self.defs.INFERENCE_BACKEND)
+        if input_size is None:
+            self.logger.warning('could not determine the model input size, so each detector will load its own model '
+                                'rather than share an inference server')
+            return
+        width, height = input_size
+        request_q = self.main_ctx.MPQueue(name='inference_requests')
+        for priority, name in enumerate(['live', 'backfill']):
+            self.inference_clients[name] = self.main_ctx.InferenceClient(name, priority, (height, width, 3), request_q)
+        backend_args = (self.defs.MODELS_DIR, self.metadata['model_id'], self.defs.INFERENCE_BACKEND,
+                        self.defs.CPU_THREADS)
+        self.main_ctx.Proc('INFER', mptools.InferenceServerWorker, request_q, list(self.inference_clients.values()),
+                           backend_args)
+
     def passive_mode(self):
         self.switch_mode('passive')
         time.sleep(10)
-        self.upload_q = self.secondary_ctx.MPQueue()
+        # the whole upload list is queued up front, so the queue is unbounded and nothing is ever dropped
+        self.upload_q = self.secondary_ctx.MPQueue(maxsize=0, policy='block', name='uploads')
         n_workers = self.queue_uploads()
         for i in range(n_workers):
             self.secondary_ctx.Proc(f'UPLOAD{i+1}', uploader.UploaderWorker, self.upload_q)
@@ -166,6 +229,7 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
 
     def hard_shutdown(self):
         self.soft_shutdown()
+        self.main_ctx.log_snapshot()
         self.main_ctx.stop_all_procs()
         self.main_ctx.stop_all_queues()
         self.logger.info(f'Program exiting')
@@ -179,6 +243,7 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
             tries_left -= 1
             if self.secondary_ctx.procs or self.secondary_ctx.queues:
                 try:
+                    self.secondary_ctx.log_snapshot()
                     self.secondary_ctx.stop_all_procs()
                     self.secondary_ctx.stop_all_queues()
                 except Exception as e:
@@ -194,8 +259,10 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
             return
 
         self.logger.debug('secondary context successfully shut down')
+        # a new secondary context is created on every mode switch, so release the pipe behind its shutdown event
+        self.secondary_ctx.shutdown_event.close()
         self.secondary_ctx = None
-        self.event_q.drain()
+        self.clean_event_queue()
 
     def mock_hit(self):
         if self.curr_mode != 'active':
@@ -228,6 +295,7 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
         proj_log_dir = definitions.PROJ_LOG_DIR(proj_id)
         proj_vid_dir = definitions.PROJ_VID_DIR(proj_id)
         proj_img_dir = definitions.PROJ_IMG_DIR(proj_id)
+        proj_dets_dir = definitions.PROJ_DETS_DIR(proj_id)
 
         if os.path.exists(proj_log_dir):
             shutil.rmtree(proj_log_dir)
@@ -237,8 +305,10 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
         upload_list.extend(glob.glob(os.path.join(proj_log_dir, '*.log')))
         upload_list.extend(glob.glob(os.path.join(proj_vid_dir, '*.h264')))
         upload_list.extend(glob.glob(os.path.join(proj_vid_dir, '*.mp4')))
+        upload_list.extend(glob.glob(os.path.join(proj_vid_dir, '*.csv')))
         upload_list.extend(glob.glob(os.path.join(proj_img_dir, '*.mp4')))
         upload_list.extend(glob.glob(os.path.join(proj_img_dir, '*.jpg')))
+        upload_list.extend(glob.glob(os.path.join(proj_dets_dir, f'*{detections.LOG_EXT}')))
         upload_list.extend(glob.glob(os.path.join(proj_dir, '*.json')))
         n_workers = min(self.MAX_UPLOAD_WORKERS, len(upload_list))
         if upload_list:
@@ -253,7 +323,7 @@ class RunnerWorker(mptools.ProcWorker, metaclass=gen_utils.AutologMetaclass):
             self.secondary_ctx.stop_procs(stop_wait_secs=600)
 
         self.switch_mode('end')
-        self.upload_q = self.secondary_ctx.MPQueue()
+        self.upload_q = self.secondary_ctx.MPQueue(maxsize=0, policy='block', name='uploads')
         proj_ids = os.listdir(self.defs.DATA_DIR)
         if not proj_ids:
             self.logger.info('no remaining data to upload. exiting')
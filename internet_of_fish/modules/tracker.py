@@ -0,0 +1,177 @@
+import numpy as np
+
+from internet_of_fish.modules import detections
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """
+    pairwise intersection over union between two sets of boxes
+    :param boxes_a: array of (xmin, ymin, xmax, ymax) boxes, with shape (n, 4)
+    :type boxes_a: np.ndarray
+    :param boxes_b: array of (xmin, ymin, xmax, ymax) boxes, with shape (m, 4)
+    :type boxes_b: np.ndarray
+    :return: array of IoU values, with shape (n, m)
+    :rtype: np.ndarray
+    """
+    inter_width = np.clip(np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2]) -
+                          np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0]), 0, None)
+    inter_height = np.clip(np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3]) -
+                           np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1]), 0, None)
+    inter = inter_width * inter_height
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+
+class Track:
+
+    __slots__ = ['track_id', 'x', 'P', 'hits', 'misses', 'dwell_secs', 'last_time']
+
+    # measurements are (cx, cy, w, h), and the state adds the velocity of the box center
+    H = np.hstack([np.eye(4), np.zeros((4, 2))])
+    R = np.diag([4.0, 4.0, 16.0, 16.0])
+    Q = np.diag([1.0, 1.0, 4.0, 4.0, 25.0, 25.0])
+
+    def __init__(self, track_id, bbox, cap_time):
+        """
+        a single fish, tracked with a constant velocity Kalman filter
+        :param track_id: unique id of the track
+        :type track_id: int
+        :param bbox: (xmin, ymin, xmax, ymax) of the detection that started the track
+        :type bbox: tuple[float, float, float, float]
+        :param cap_time: capture time of the frame the detection came from, in ms
+        :type cap_time: int
+        """
+        self.track_id = track_id
+        self.x = np.zeros(6)
+        self.x[:4] = self.to_measurement(bbox)
+        self.P = np.diag([10.0, 10.0, 10.0, 10.0, 100.0, 100.0])
+        self.hits = 1
+        self.misses = 0
+        self.dwell_secs = 0.0
+        self.last_time = cap_time
+
+    @staticmethod
+    def to_measurement(bbox):
+        xmin, ymin, xmax, ymax = bbox
+        return np.array([(xmin + xmax) / 2, (ymin + ymax) / 2, xmax - xmin, ymax - ymin])
+
+    @property
+    def bbox(self):
+        cx, cy, w, h = self.x[:4]
+        return cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2
+
+    def predict(self, cap_time):
+        """advance the state to cap_time
+        :return: time since the last prediction, in seconds
+        :rtype: float
+        """
+        dt = max(0.0, (cap_time - self.last_time) / 1000)
+        F = np.eye(6)
+        F[0, 4] = F[1, 5] = dt
+        self.x = F @ self.x
+        self.x[2:4] = np.maximum(self.x[2:4], 1.0)
+        self.P = F @ self.P @ F.T + self.Q * dt
+        self.last_time = cap_time
+        return dt
+
+    def update(self, bbox):
+        """correct the (already predicted) state with a matched detection"""
+        y = self.to_measurement(bbox) - self.H @ self.x
+        S = self.H @ self.P @ self.H.T + self.R
+        K = self.P @ self.H.T @ np.linalg.inv(S)
+        self.x = self.x + K @ y
+        self.P = (np.eye(6) - K @ self.H) @ self.P
+        self.hits += 1
+        self.misses = 0
+
+
+class Tracker:
+
+    def __init__(self, iou_thresh=0.3, max_misses=5, min_hits=2, inside_frac=0.9):
+        """
+        IoU-matched multi-object tracker that follows each fish from frame to frame, and measures how long each one
+        has been inside the pipe.
+
+        Between detections (e.g., when inference only runs on every nth frame), tracks are carried forward by their
+        Kalman filters. Tracks are only counted once they have been matched in min_hits frames, and are dropped after
+        going unmatched in more than max_misses consecutive detection frames
+        :param iou_thresh: minimum IoU between a track and a detection for the two to be matched
+        :type iou_thresh: float
+        :param max_misses: number of consecutive detection frames a track can go unmatched before it is dropped
+        :type max_misses: int
+        :param min_hits: number of matched frames before a track is considered confirmed
+        :type min_hits: int
+        :param inside_frac: minimum fraction of a fish's box that must overlap the pipe for it to count as inside
+        :type inside_frac: float
+        """
+        self.iou_thresh = iou_thresh
+        self.max_misses = max_misses
+        self.min_hits = min_hits
+        self.inside_frac = inside_frac
+        self.tracks = []
+        self.next_id = 0
+
+    @property
+    def confirmed_tracks(self):
+        return [track for track in self.tracks if track.hits >= self.min_hits]
+
+    def propagate(self, cap_time):
+        """carry every track forward to cap_time without a new set of detections"""
+        for track in self.tracks:
+            track.predict(cap_time)
+
+    def update(self, dets, cap_time):
+        """
+        match a new set of detections to the existing tracks, starting new tracks for any detections left unmatched
+        :param dets: fish detections for the frame (see detections.DET_DTYPE)
+        :type dets: np.ndarray
+        :param cap_time: capture time of the frame, in ms
+        :type cap_time: int
+        """
+        self.propagate(cap_time)
+        det_boxes = detections.boxes(dets)
+        unmatched_dets = set(range(len(dets)))
+        unmatched_tracks = set(range(len(self.tracks)))
+        if self.tracks and len(dets):
+            ious = iou_matrix(np.array([track.bbox for track in self.tracks]), det_boxes)
+            # greedy matching, best overlap first
+            for flat_idx in np.argsort(-ious, axis=None):
+                track_idx, det_idx = np.unravel_index(flat_idx, ious.shape)
+                if ious[track_idx, det_idx] < self.iou_thresh:
+                    break
+                if track_idx in unmatched_tracks and det_idx in unmatched_dets:
+                    self.tracks[track_idx].update(det_boxes[det_idx])
+                    unmatched_tracks.discard(track_idx)
+                    unmatched_dets.discard(det_idx)
+        for track_idx in unmatched_tracks:
+            self.tracks[track_idx].misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+        for det_idx in sorted(unmatched_dets):
+            self.tracks.append(Track(self.next_id, det_boxes[det_idx], cap_time))
+            self.next_id += 1
+
+    def update_dwell(self, pipe_bbox, dt):
+        """
+        add dt to the dwell time of each confirmed track that is inside the pipe, and reset it for the rest
+        :param pipe_bbox: (xmin, ymin, xmax, ymax) of the pipe
+        :type pipe_bbox: np.ndarray
+        :param dt: time since the last call, in seconds
+        :type dt: float
+        """
+        tracks = self.confirmed_tracks
+        if not tracks:
+            return
+        boxes = np.array([track.bbox for track in tracks])
+        inside = detections.inside(boxes, np.asarray(pipe_bbox, dtype=np.float64), self.inside_frac)
+        for track, is_inside in zip(tracks, inside):
+            track.dwell_secs = track.dwell_secs + dt if is_inside else 0.0
+
+    def n_dwelling(self, min_dwell_secs):
+        """number of confirmed tracks that have been inside the pipe for at least min_dwell_secs"""
+        return sum(track.dwell_secs >= min_dwell_secs for track in self.confirmed_tracks)
+
+    def reset_dwell(self):
+        for track in self.tracks:
+            track.dwell_secs = 0.0
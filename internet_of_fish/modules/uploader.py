@@ -84,7 +84,7 @@ class EndUploaderWorker(UploaderWorker):
     def main_loop(self):
         self.logger.debug("Entering QueueProcWorker.main_loop")
         while not self.shutdown_event.is_set():
-            item = self.work_q.safe_get()
+            item = self.work_q.wait_get(wakeup=self.shutdown_event)
             if not item:
                 continue
             self.logger.debug(f"QueueProcWorker.main_loop received '{item}' message")
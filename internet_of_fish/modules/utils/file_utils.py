@@ -35,7 +35,8 @@ def create_project_tree(proj_id):
     for dir_func in [definitions.PROJ_DIR,
                      definitions.PROJ_IMG_DIR,
                      definitions.PROJ_VID_DIR,
-                     definitions.PROJ_LOG_DIR]:
+                     definitions.PROJ_LOG_DIR,
+                     definitions.PROJ_DETS_DIR]:
         path = dir_func(proj_id)
         if not os.path.exists(path):
             os.makedirs(path)
@@ -273,3 +273,46 @@ class Averager:
 
 
 
+
+
+class RateController:
+
+    def __init__(self, interval, min_interval, max_interval, target_occupancy=0.2, gain=0.5):
+        """
+        closed-loop controller for the interval at which a producer adds items to a bounded queue
+
+        holds the queue depth near target_occupancy by lengthening the interval while the queue is fuller than the
+        target, and shortening it again once the consumer catches up. The interval never drops below the consumer's
+        measured service time (since adding items any faster would only fill the queue) and is always kept between
+        min_interval and max_interval
+        :param interval: starting interval, in seconds
+        :type interval: float
+        :param min_interval: shortest allowed interval, in seconds
+        :type min_interval: float
+        :param max_interval: longest allowed interval, in seconds
+        :type max_interval: float
+        :param target_occupancy: queue depth to aim for, as a fraction of the queue capacity
+        :type target_occupancy: float
+        :param gain: fractional change in interval per update, per unit of occupancy error
+        :type gain: float
+        """
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_occupancy = target_occupancy
+        self.gain = gain
+
+    def update(self, occupancy, service_time=0.0):
+        """
+        adjust the interval based on the current state of the queue and its consumer
+        :param occupancy: current queue depth as a fraction of the queue capacity
+        :type occupancy: float
+        :param service_time: consumer's recent average time to process one item, in seconds
+        :type service_time: float
+        :return: the updated interval, in seconds
+        :rtype: float
+        """
+        interval = self.interval * (1 + self.gain * (occupancy - self.target_occupancy))
+        floor = max(self.min_interval, service_time)
+        self.interval = min(self.max_interval, max(floor, interval))
+        return self.interval
@@ -0,0 +1,57 @@
+from collections import namedtuple
+
+import numpy as np
+
+from internet_of_fish.modules import detections
+
+Obj = namedtuple('Obj', ['id', 'score', 'bbox'])
+
+
+def test_from_objects():
+    objs = [Obj(0, 0.5, (0, 0, 10, 10)), Obj(1, 0.9, (20, 20, 40, 40))]
+    dets = detections.from_objects(objs, offset=(5, 10))
+    assert dets.dtype == detections.DET_DTYPE
+    assert dets['id'].tolist() == [0, 1]
+    assert np.allclose(detections.boxes(dets), [[5, 10, 15, 20], [25, 30, 45, 50]])
+    assert detections.boxes(detections.from_objects([])).shape == (0, 4)
+
+
+def test_select():
+    dets = detections.from_objects([Obj(0, 0.5, (0, 0, 1, 1)), Obj(1, 0.9, (0, 0, 1, 1)),
+                                    Obj(0, 0.8, (0, 0, 1, 1)), Obj(0, 0.7, (0, 0, 1, 1))])
+    assert np.allclose(detections.select(dets, 0, 2)['score'], [0.8, 0.7])
+    assert len(detections.select(dets, 0)) == 3
+    assert len(detections.select(dets, 2)) == 0
+
+
+def test_inside():
+    boxes = np.array([[10, 10, 20, 20], [0, 0, 100, 50], [90, 10, 110, 20]], dtype=float)
+    container = np.array([0, 0, 100, 50], dtype=float)
+    assert np.allclose(detections.containment(boxes, container), [1.0, 1.0, 0.5])
+    assert detections.inside(boxes, container).tolist() == [True, True, False]
+    assert detections.inside(boxes, container, min_frac=0.5).tolist() == [True, True, True]
+
+
+def test_detection_log(tmp_path):
+    log = detections.DetectionLog(str(tmp_path), chunk_records=4, buffer_records=2)
+    frame_dets = detections.from_objects([Obj(0, 0.5, (0, 0, 10, 10)), Obj(1, 0.9, (20, 20, 40, 40))])
+    for cap_time in range(3):
+        log.write(cap_time, frame_dets)
+    log.write(3, detections.empty())
+    log.write(4, frame_dets, inferred=False)
+    log.close()
+    chunks = detections.load_logs(str(tmp_path))
+    assert [len(chunk) for chunk in chunks] == [4, 4]
+    records = np.concatenate(chunks)
+    assert records['cap_time'].tolist() == [0, 0, 1, 1, 2, 2, 3, 4]
+    assert records['id'].tolist() == [0, 1, 0, 1, 0, 1, detections.NO_DETS, detections.NOT_INFERRED]
+    assert np.allclose(records['xmax'][:2], [10, 40])
+
+
+def test_load_log_ignores_partial_record(tmp_path):
+    log = detections.DetectionLog(str(tmp_path))
+    log.write(0, detections.from_objects([Obj(0, 0.5, (0, 0, 10, 10))]))
+    log.close()
+    with open(log.chunk_path, 'ab') as f:
+        f.write(b'\x00' * 5)
+    assert len(detections.load_log(log.chunk_path)) == 1
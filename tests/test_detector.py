@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from internet_of_fish.modules import detector
+from internet_of_fish.modules.detections import DET_DTYPE
+
+
+def make_dets(*rows):
+    return np.array(list(rows), dtype=DET_DTYPE)
+
+
+def test_non_max_suppression():
+    dets = make_dets((0, 0.6, 0, 0, 10, 10), (0, 0.9, 1, 1, 11, 11), (1, 0.5, 1, 1, 11, 11), (0, 0.7, 50, 50, 60, 60))
+    kept = detector.non_max_suppression(dets, 0.5)
+    assert kept['score'].tolist() == pytest.approx([0.9, 0.7, 0.5])
+    assert kept['id'].tolist() == [0, 0, 1]
+    assert not len(detector.non_max_suppression(make_dets()))
+
+
+def test_event_buffer():
+    buffer = detector.EventBuffer(max_bytes=10)
+    for cap_time in range(5):
+        buffer.append(detector.BufferEntry(cap_time, b'1234', None))
+    assert len(buffer) == 2 and buffer.nbytes == 8
+    assert [entry.cap_time for entry in buffer.flush()] == [3, 4]
+    assert len(buffer) == 0 and buffer.nbytes == 0
+
+
+def test_motion_gate():
+    gate = detector.MotionGate(threshold=0.01, max_skip_ratio=0.75)
+    still = np.zeros((96, 128, 3), dtype=np.uint8)
+    moving = still.copy()
+    moving[:48] = 255
+    assert gate.check(still)
+    # a static scene is skipped, but never more than 3 frames in a row
+    assert [gate.check(still) for _ in range(4)] == [False, False, False, True]
+    assert gate.check(moving)
+    assert gate.skip_ratio == pytest.approx(3 / 6)
+
+
+def test_pipe_cache():
+    cache = detector.PipeCache(warmup_frames=4, revalidate_secs=10)
+    pipe = make_dets((1, 0.9, 100, 100, 200, 150))
+    assert cache.collecting(0)
+    assert [cache.update(pipe if i != 1 else make_dets(), i * 500) for i in range(4)] == [False] * 3 + [True]
+    assert cache.bbox.tolist() == [100, 100, 200, 150]
+    assert not cache.collecting(2000)
+    assert cache.roi(640, 480, 0.5) == (50, 75, 250, 175)
+    # after the revalidation window, a pipe that has moved replaces the cached box
+    moved = make_dets((1, 0.9, 300, 300, 400, 350))
+    assert cache.collecting(1500 + 10000)
+    assert [cache.update(moved, 11500 + i * 500) for i in range(4)] == [False] * 3 + [True]
+    assert cache.bbox.tolist() == [300, 300, 400, 350]
@@ -0,0 +1,103 @@
+import os
+from collections import namedtuple
+
+import pytest
+import numpy as np
+
+from internet_of_fish.modules import inference
+
+# stand-in for pycoral's detect.Object, which has the same fields
+Object = namedtuple('Object', ['id', 'score', 'bbox'])
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    model_dir = tmp_path / 'test_model'
+    model_dir.mkdir()
+    for fname in ['model.tflite', 'model_edgetpu.tflite', 'labels.txt']:
+        (model_dir / fname).touch()
+    yield str(tmp_path)
+
+
+@pytest.mark.parametrize('edgetpu,expected', [(True, 'model_edgetpu.tflite'), (False, 'model.tflite')])
+def test_locate_model(model_dir, edgetpu, expected):
+    model_path, label_path = inference.locate_model(model_dir, 'test_model', edgetpu=edgetpu)
+    assert os.path.basename(model_path) == expected
+    assert os.path.basename(label_path) == 'labels.txt'
+
+
+def test_locate_model_fallback(model_dir):
+    os.remove(os.path.join(model_dir, 'test_model', 'model.tflite'))
+    model_path, _ = inference.locate_model(model_dir, 'test_model', edgetpu=False)
+    assert os.path.basename(model_path) == 'model_edgetpu.tflite'
+
+
+def test_make_fake_backend(model_dir):
+    backend, label_path = inference.make_backend(model_dir, 'test_model', 'fake')
+    assert isinstance(backend, inference.FakeBackend)
+    assert os.path.basename(label_path) == 'labels.txt'
+
+
+def test_fake_backend_detect():
+    dets = [Object(0, 0.4, (0, 0, 10, 10)), Object(1, 0.9, (5, 5, 20, 20))]
+    backend = inference.FakeBackend(dets)
+    frame = np.zeros((*backend.input_size[::-1], 3), dtype=np.uint8)
+    assert backend.detect(frame, (1.0, 1.0), 0.5) == [dets[1]]
+    assert backend.detect(frame, (1.0, 1.0), 0.0) == [dets[1], dets[0]]
+    assert backend.call_count == 2
+
+
+def test_read_labels(tmp_path):
+    plain = tmp_path / 'plain.txt'
+    plain.write_text('fish\npipe\n')
+    numbered = tmp_path / 'numbered.txt'
+    numbered.write_text('0 fish\n2: pipe\n')
+    assert inference.read_labels(str(plain)) == {0: 'fish', 1: 'pipe'}
+    assert inference.read_labels(str(numbered)) == {0: 'fish', 2: 'pipe'}
+
+
+def test_decode_ssd():
+    boxes = np.array([[0.1, 0.2, 0.5, 0.6], [0.0, 0.0, 1.0, 1.0], [0, 0, 0, 0]], dtype=np.float32)
+    objs = inference.decode_ssd(boxes, np.array([1, 0, 0]), np.array([0.9, 0.3, 0.0]), 2, (320, 320), (0.5, 0.5),
+                                0.5)
+    assert objs == [inference.Object(1, pytest.approx(0.9), (128, 64, 384, 320))]
+
+
+class FakeInterpreter:
+
+    """just enough of the tflite Interpreter interface for an SSD model with TF1-ordered outputs"""
+
+    def __init__(self):
+        self.tensors = {0: np.zeros((1, 20, 30, 3), dtype=np.uint8),
+                        1: np.array([[[0.0, 0.0, 0.5, 0.5]]], dtype=np.float32),
+                        2: np.array([[3]], dtype=np.float32),
+                        3: np.array([[0.8]], dtype=np.float32),
+                        4: np.array([1], dtype=np.float32)}
+        self.input_sum = None
+
+    def allocate_tensors(self):
+        pass
+
+    def get_input_details(self):
+        return [{'index': 0, 'shape': np.array(self.tensors[0].shape)}]
+
+    def get_output_details(self):
+        return [{'index': i, 'shape': np.array(self.tensors[i].shape)} for i in range(1, 5)]
+
+    def tensor(self, index):
+        return lambda: self.tensors[index]
+
+    def invoke(self):
+        self.input_sum = int(self.tensors[0].sum())
+
+
+def test_tflite_backend_detect():
+    class FakeTFLiteBackend(inference.TFLiteBackend):
+        def make_interpreter(self):
+            return FakeInterpreter()
+
+    backend = FakeTFLiteBackend('model.tflite')
+    assert backend.input_size == (30, 20)
+    objs = backend.detect(np.ones((10, 30, 3), dtype=np.uint8), (1.0, 1.0), 0.5)
+    assert backend.interpreter.input_sum == 10 * 30 * 3
+    assert objs == [inference.Object(3, pytest.approx(0.8), (0, 0, 15, 10))]
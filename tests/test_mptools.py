@@ -0,0 +1,230 @@
+import time
+
+from internet_of_fish.modules import mptools
+from internet_of_fish.modules.utils import gen_utils
+import pytest
+import numpy as np
+from PIL import Image
+from numpy.random import rand
+import multiprocessing as mp
+import signal
+import threading
+import types
+
+# MPQueue testing
+
+def random_image():
+    imarray = rand(100, 100, 3) * 255
+    im = Image.fromarray(imarray.astype('uint8')).convert('RGB')
+    return im
+
+
+@pytest.fixture
+def explicit_mpqueue():
+    q = mptools.MPQueue()
+    yield q
+    if not q._closed:
+        q.drain()
+        q.safe_close()
+
+
+@pytest.fixture
+def explicit_img_queue():
+    q = mptools.MPQueue()
+    cap_time = gen_utils.current_time_ms()
+    for _ in range(10):
+        img = random_image()
+        q.safe_put((cap_time, img))
+        cap_time += 500
+    yield q
+    if not q._closed:
+        q.drain()
+        q.safe_close()
+
+
+@pytest.mark.parametrize('item', ['a', 1.1, random_image()])
+def test_mpqueu_safe_put(explicit_mpqueue, item):
+    assert explicit_mpqueue.safe_put(item)
+
+
+@pytest.mark.parametrize('item', ['a', 1.1, random_image()])
+def test_mpqueue_safe_get(explicit_mpqueue, item):
+    explicit_mpqueue.safe_put(item)
+    ret_item = explicit_mpqueue.safe_get()
+    assert ret_item == item
+
+
+def test_mpqueue_safe_get_empty(explicit_mpqueue):
+    assert explicit_mpqueue.safe_get() is None
+
+
+def test_mpqueue_drain(explicit_img_queue):
+    explicit_img_queue.drain()
+    explicit_img_queue.safe_get()
+    assert explicit_img_queue.safe_get() is None
+
+
+def test_mpqueue_drain_returns_items(explicit_mpqueue):
+    explicit_mpqueue.put_many(['a', 'b'])
+    explicit_mpqueue.safe_put('c')
+    start = time.time()
+    assert explicit_mpqueue.drain() == ['a', 'b', 'c']
+    assert time.time() - start < 0.5
+
+
+def test_mpqueue_batches(explicit_mpqueue):
+    assert explicit_mpqueue.put_many(list(range(5)))
+    explicit_mpqueue.safe_put(5)
+    time.sleep(0.1)
+    assert explicit_mpqueue.get_many(3) == [0, 1, 2]
+    assert explicit_mpqueue.safe_get() == 3
+    assert explicit_mpqueue.get_many() == [4, 5]
+    assert explicit_mpqueue.get_many(timeout=None) == []
+
+
+def test_mpqueue_safe_close(explicit_img_queue):
+    explicit_img_queue.safe_close()
+    assert explicit_img_queue._closed
+
+
+def test_mpqueue_wait_get(explicit_mpqueue):
+    explicit_mpqueue.safe_put('a')
+    assert explicit_mpqueue.wait_get(timeout=1) == 'a'
+    start = time.time()
+    assert explicit_mpqueue.wait_get(timeout=0.1) is None
+    assert time.time() - start >= 0.1
+
+
+def test_mpqueue_wait_get_wakeup(explicit_mpqueue):
+    shutdown_event = mptools.ShutdownEvent()
+    threading.Timer(0.1, shutdown_event.set).start()
+    start = time.time()
+    assert explicit_mpqueue.wait_get(wakeup=shutdown_event) is None
+    assert shutdown_event.is_set() and time.time() - start < 5
+
+
+def test_shutdown_event_close():
+    shutdown_event = mptools.ShutdownEvent()
+    shutdown_event.close()
+    shutdown_event.set()
+    assert shutdown_event.is_set()
+
+
+@pytest.mark.parametrize('policy,expected', [('drop_newest', [0, 1, 2]), ('drop_oldest', [3, 4, 5]),
+                                             ('every_nth', [1, 2, 4]), ('block', [0, 1, 2])])
+def test_mpqueue_overflow_policy(policy, expected):
+    q = mptools.MPQueue(maxsize=3, policy=policy, every_n=2)
+    for i in range(6):
+        q.safe_put(i)
+    time.sleep(0.1)
+    assert [q.safe_get() for _ in range(3)] == expected
+    assert q.overflow.dropped.value + q.overflow.evicted.value == 3
+    q.safe_close()
+
+
+def test_mpqueue_snapshot(explicit_mpqueue):
+    explicit_mpqueue.safe_put('a')
+    explicit_mpqueue.safe_put('b')
+    assert explicit_mpqueue.wait_get(timeout=1) == 'a'
+    snapshot = explicit_mpqueue.snapshot()
+    assert snapshot['put'] == 2 and snapshot['got'] == 1
+    assert sum(snapshot['wait_secs']['counts']) == 1
+    assert sum(snapshot['occupancy']['counts']) == 2
+
+
+def test_shared_stats_quantile():
+    stats = mptools.SharedStats(['n'], {'secs': [1, 2, 4]})
+    assert stats.quantile(stats.snapshot()['secs'], 0.5) is None
+    for val in [0.5, 1.5, 1.5, 3, 10]:
+        stats.record('secs', val)
+    stats.incr('n', 5)
+    snapshot = stats.snapshot()
+    assert snapshot['n'] == 5
+    assert snapshot['secs']['counts'] == [1, 2, 1, 1]
+    assert stats.quantile(snapshot['secs'], 0.5) == 2
+    assert stats.quantile(snapshot['secs'], 1.0) == float('inf')
+
+
+def test_inference_client_dropped_request():
+    request_q = mptools.MPQueue(maxsize=1)
+    request_q.safe_put('busy')
+    client = mptools.InferenceClient('live', 0, (10, 10, 3), request_q)
+    with pytest.raises(mptools.InferenceUnavailable):
+        client.detect(np.zeros((10, 10, 3), dtype=np.uint8), (1.0, 1.0), 0.5)
+    assert client.stats.snapshot()['failures'] == 1
+    request_q.drain()
+    request_q.safe_close()
+    client.response_q.safe_close()
+
+
+# FrameRingBuffer testing
+
+@pytest.fixture
+def explicit_ring_buffer():
+    rb = mptools.FrameRingBuffer(3, (100, 100, 3))
+    yield rb
+    if not rb._closed:
+        rb.safe_close()
+
+
+def test_ring_buffer_round_trip(explicit_ring_buffer):
+    frame = np.asarray(random_image())
+    assert explicit_ring_buffer.safe_put((0, frame))
+    frame_ref = explicit_ring_buffer.safe_get()
+    assert isinstance(frame_ref, mptools.FrameRef) and frame_ref.cap_time == 0
+    assert np.array_equal(explicit_ring_buffer.view(frame_ref), frame)
+    explicit_ring_buffer.release(frame_ref)
+
+
+def test_ring_buffer_full(explicit_ring_buffer):
+    frame = np.asarray(random_image())
+    results = [explicit_ring_buffer.safe_put((i, frame)) for i in range(4)]
+    assert results == [True, True, True, False]
+
+
+def test_ring_buffer_drop_oldest():
+    rb = mptools.FrameRingBuffer(3, (10, 10, 3), policy='drop_oldest')
+    time.sleep(0.1)
+    for i in range(5):
+        assert rb.safe_put((i, np.full((10, 10, 3), i, dtype=np.uint8)))
+    frame_refs = [rb.safe_get() for _ in range(3)]
+    assert [frame_ref.cap_time for frame_ref in frame_refs] == [2, 3, 4]
+    assert all(rb.view(frame_ref)[0, 0, 0] == frame_ref.cap_time for frame_ref in frame_refs)
+    assert rb.overflow.evicted.value == 2
+    rb.safe_close()
+
+
+def test_ring_buffer_passthrough(explicit_ring_buffer):
+    explicit_ring_buffer.safe_put('END')
+    assert explicit_ring_buffer.safe_get() == 'END'
+
+
+# Proc shutdown testing
+
+def ignore_sigterm(secs):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    time.sleep(secs)
+
+
+def make_bare_proc(name, target, *args):
+    proc = mp.Process(target=target, args=args)
+    proc.start()
+    return types.SimpleNamespace(name=name, proc=proc, logger=gen_utils.make_logger(name))
+
+
+def test_wait_for_procs_waits_concurrently():
+    procs = [make_bare_proc(f'sleep{i}', time.sleep, 0.3) for i in range(4)]
+    start = time.time()
+    exit_secs = mptools.wait_for_procs(procs, 5)
+    assert sorted(exit_secs) == ['sleep0', 'sleep1', 'sleep2', 'sleep3']
+    assert time.time() - start < 1
+
+
+def test_terminate_procs_escalates():
+    procs = [make_bare_proc('stubborn', ignore_sigterm, 30), make_bare_proc('sleeper', time.sleep, 30)]
+    time.sleep(0.2)
+    start = time.time()
+    exit_secs = mptools.terminate_procs(procs, 0.5)
+    assert time.time() - start < 1.5
+    assert exit_secs['sleeper'] < 0.5 <= exit_secs['stubborn'] < 1.5
+    assert procs[0].proc.exitcode == -9 and procs[1].proc.exitcode == -15
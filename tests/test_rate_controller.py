@@ -0,0 +1,24 @@
+import pytest
+
+from internet_of_fish.modules.utils import gen_utils
+
+
+@pytest.mark.parametrize('occupancy,service_time,expected_interval',
+                         [(0.2, 0.0, 1.0),
+                          (1.0, 0.0, 1.4),
+                          (0.0, 0.0, 0.9),
+                          (0.0, 0.95, 0.95),
+                          (1.0, 5.0, 2.0)])
+def test_rate_controller_update(occupancy, service_time, expected_interval):
+    controller = gen_utils.RateController(1.0, 0.5, 2.0, target_occupancy=0.2, gain=0.5)
+    assert controller.update(occupancy, service_time) == pytest.approx(expected_interval)
+
+
+def test_rate_controller_recovers():
+    controller = gen_utils.RateController(0.5, 0.5, 5.0)
+    for _ in range(10):
+        controller.update(1.0)
+    assert controller.interval > 0.5
+    for _ in range(100):
+        controller.update(0.0)
+    assert controller.interval == 0.5
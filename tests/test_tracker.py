@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from internet_of_fish.modules import tracker
+from internet_of_fish.modules.detections import DET_DTYPE
+
+
+def make_dets(*bboxes):
+    return np.array([(0, 0.9, *bbox) for bbox in bboxes], dtype=DET_DTYPE)
+
+
+def moving_det(step, speed=5):
+    return make_dets((100 + speed * step, 100, 150 + speed * step, 130))
+
+
+@pytest.fixture
+def explicit_tracker():
+    return tracker.Tracker(iou_thresh=0.3, max_misses=2, min_hits=2)
+
+
+def test_iou_matrix():
+    boxes_a = np.array([[0, 0, 10, 10], [20, 20, 30, 30]], dtype=float)
+    boxes_b = np.array([[0, 0, 10, 10], [5, 0, 15, 10]], dtype=float)
+    ious = tracker.iou_matrix(boxes_a, boxes_b)
+    assert ious.shape == (2, 2)
+    assert np.allclose(ious, [[1.0, 1 / 3], [0.0, 0.0]])
+
+
+def test_tracker_keeps_identity(explicit_tracker):
+    for step in range(10):
+        explicit_tracker.update(moving_det(step), step * 500)
+    assert len(explicit_tracker.tracks) == 1
+    assert explicit_tracker.tracks[0].track_id == 0
+    assert len(explicit_tracker.confirmed_tracks) == 1
+
+
+def test_tracker_propagates_between_detections(explicit_tracker):
+    for step in range(5):
+        explicit_tracker.update(moving_det(step), step * 500)
+    explicit_tracker.propagate(5 * 500)
+    explicit_tracker.update(moving_det(6), 6 * 500)
+    assert len(explicit_tracker.tracks) == 1
+
+
+def test_tracker_drops_lost_tracks(explicit_tracker):
+    explicit_tracker.update(moving_det(0), 0)
+    for step in range(1, 5):
+        explicit_tracker.update(make_dets(), step * 500)
+    assert not explicit_tracker.tracks
+
+
+def test_dwell_time(explicit_tracker):
+    pipe_bbox = np.array([50, 50, 300, 200])
+    fish = make_dets((100, 100, 150, 130), (200, 100, 250, 130))
+    for step in range(11):
+        explicit_tracker.update(fish, step * 500)
+        explicit_tracker.update_dwell(pipe_bbox, 0.5)
+    assert explicit_tracker.n_dwelling(4) == 2
+    explicit_tracker.reset_dwell()
+    assert explicit_tracker.n_dwelling(4) == 0